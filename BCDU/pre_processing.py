@@ -55,15 +55,15 @@ def clahe_equalized(imgs):
 
 
 # ===== normalize over the dataset
+#the min-max rescale of each image cancels the dataset mean/std, images are rescaled one by one in float32
 def dataset_normalized(imgs):
     assert (len(imgs.shape)==4)  #4D arrays
     assert (imgs.shape[1]==1)  #check the channel is 1
-    imgs_normalized = np.empty(imgs.shape)
-    imgs_std = np.std(imgs)
-    imgs_mean = np.mean(imgs)
-    imgs_normalized = (imgs-imgs_mean)/imgs_std
+    imgs_normalized = np.empty(imgs.shape, dtype=np.float32)
     for i in range(imgs.shape[0]):
-        imgs_normalized[i] = ((imgs_normalized[i] - np.min(imgs_normalized[i])) / (np.max(imgs_normalized[i])-np.min(imgs_normalized[i])))*255
+        img_min = np.min(imgs[i])
+        np.subtract(imgs[i], img_min, out=imgs_normalized[i], casting='unsafe')
+        imgs_normalized[i] *= np.float32(255. / (np.max(imgs[i]) - img_min))
     return imgs_normalized
 
 
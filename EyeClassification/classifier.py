@@ -4,12 +4,20 @@ import numpy as np
 import os
 cur_dir = os.path.dirname(os.path.realpath(__file__))
 os.sys.path.insert(-1, cur_dir)
+os.sys.path.insert(-1, os.path.dirname(cur_dir))
 
 from helper_utils import is_fundus
+from serving import lazy_model
 # MODEL_WEIGHT_FILE = os.path.join(cur_dir, 'weights-1859-0.0198-0.9883-0.0826-0.9400.hdf5')
 MODEL_WEIGHT_FILE = os.path.join(cur_dir, 'new_model/weights-0274-0.0639-0.9749-0.2027-0.9703.hdf5')
+SERVING_DIR = os.path.join(cur_dir, 'new_model/serving')     # written by export_models.py, MODEL_WEIGHT_FILE is used when missing
 
-model = tf.keras.models.load_model(MODEL_WEIGHT_FILE)
+
+def build_model():
+    return tf.keras.models.load_model(MODEL_WEIGHT_FILE)
+
+
+get_model = lazy_model(SERVING_DIR, build_model)
 
 
 def classify(images):
@@ -24,7 +32,7 @@ def classify(images):
     #     else:
     #         invalid_index.append(i)
     # resized_images = resized_images[valid_index]
-    prediction = model.predict(resized_images, batch_size=16)
+    prediction = get_model().predict(resized_images, batch_size=16)
     classes =[]
     for p in prediction:
         if p[0] < 0.5:
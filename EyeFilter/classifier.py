@@ -3,17 +3,27 @@ from glob import glob
 import numpy as np
 import os
 cur_dir = os.path.dirname(os.path.realpath(__file__))
+os.sys.path.insert(-1, os.path.dirname(cur_dir))
+
+from serving import lazy_model
 
 MODEL_WEIGHT_FILE = os.path.join(cur_dir, 'weights-0197-0.0045-0.9951-0.0076-1.0000.hdf5')
+SERVING_DIR = os.path.join(cur_dir, 'serving')     # written by export_models.py, MODEL_WEIGHT_FILE is used when missing
+
+
 # TODO: Need to Fix Model
-model = tf.keras.models.load_model(MODEL_WEIGHT_FILE)
+def build_model():
+    return tf.keras.models.load_model(MODEL_WEIGHT_FILE)
+
+
+get_model = lazy_model(SERVING_DIR, build_model)
 
 
 def classify(images, min_images=5):
     resized_images = tf.image.resize(images, size=(256, 256)).numpy()
     if np.max(resized_images) > 1:
         resized_images = np.array(resized_images/255., dtype=np.float32)
-    predictions = model.predict(resized_images, batch_size=16).flatten()
+    predictions = get_model().predict(resized_images, batch_size=16).flatten()
     print(predictions)
     valid_images = np.zeros(len(images), dtype=np.int)
 
@@ -12,7 +12,7 @@ import tensorflow as tf
 from SegCaps.capsule_layers import ConvCapsuleLayer, DeconvCapsuleLayer, Mask, Length
 
 
-def CapsNetR3(input_shape, n_class=2):
+def CapsNetR3(input_shape, n_class=2, routing_chunk=None, grouped_votes=False, seg_only=False):
     x = tf.keras.layers.Input(shape=input_shape)
 
     # Layer 1: Just a conventional Conv2D layer
@@ -24,31 +24,37 @@ def CapsNetR3(input_shape, n_class=2):
 
     # Layer 1: Primary Capsule: Conv cap with routing 1
     primary_caps = ConvCapsuleLayer(kernel_size=5, num_capsule=2, num_atoms=16, strides=2, padding='same',
-                                    routings=1, name='primarycaps')(conv1_reshaped)
+                                    routings=1, routing_chunk=routing_chunk,
+                                    grouped_votes=grouped_votes, name='primarycaps')(conv1_reshaped)
 
     # Layer 2: Convolutional Capsule
     conv_cap_2_1 = ConvCapsuleLayer(kernel_size=5, num_capsule=4, num_atoms=16, strides=1, padding='same',
-                                    routings=3, name='conv_cap_2_1')(primary_caps)
+                                    routings=3, routing_chunk=routing_chunk,
+                                    grouped_votes=grouped_votes, name='conv_cap_2_1')(primary_caps)
 
     # Layer 2: Convolutional Capsule
     conv_cap_2_2 = ConvCapsuleLayer(kernel_size=5, num_capsule=4, num_atoms=32, strides=2, padding='same',
-                                    routings=3, name='conv_cap_2_2')(conv_cap_2_1)
+                                    routings=3, routing_chunk=routing_chunk,
+                                    grouped_votes=grouped_votes, name='conv_cap_2_2')(conv_cap_2_1)
 
     # Layer 3: Convolutional Capsule
     conv_cap_3_1 = ConvCapsuleLayer(kernel_size=5, num_capsule=8, num_atoms=32, strides=1, padding='same',
-                                    routings=3, name='conv_cap_3_1')(conv_cap_2_2)
+                                    routings=3, routing_chunk=routing_chunk,
+                                    grouped_votes=grouped_votes, name='conv_cap_3_1')(conv_cap_2_2)
 
     # Layer 3: Convolutional Capsule
     conv_cap_3_2 = ConvCapsuleLayer(kernel_size=5, num_capsule=8, num_atoms=64, strides=2, padding='same',
-                                    routings=3, name='conv_cap_3_2')(conv_cap_3_1)
+                                    routings=3, routing_chunk=routing_chunk,
+                                    grouped_votes=grouped_votes, name='conv_cap_3_2')(conv_cap_3_1)
 
     # Layer 4: Convolutional Capsule
     conv_cap_4_1 = ConvCapsuleLayer(kernel_size=5, num_capsule=8, num_atoms=32, strides=1, padding='same',
-                                    routings=3, name='conv_cap_4_1')(conv_cap_3_2)
+                                    routings=3, routing_chunk=routing_chunk,
+                                    grouped_votes=grouped_votes, name='conv_cap_4_1')(conv_cap_3_2)
 
     # Layer 1 Up: Deconvolutional Capsule
     deconv_cap_1_1 = DeconvCapsuleLayer(kernel_size=4, num_capsule=8, num_atoms=32, upsamp_type='deconv',
-                                        scaling=2, padding='same', routings=3,
+                                        scaling=2, padding='same', routings=3, grouped_votes=grouped_votes,
                                         name='deconv_cap_1_1')(conv_cap_4_1)
 
     # Skip connection
@@ -56,11 +62,12 @@ def CapsNetR3(input_shape, n_class=2):
 
     # Layer 1 Up: Deconvolutional Capsule
     deconv_cap_1_2 = ConvCapsuleLayer(kernel_size=5, num_capsule=4, num_atoms=32, strides=1,
-                                      padding='same', routings=3, name='deconv_cap_1_2')(up_1)
+                                      padding='same', routings=3, routing_chunk=routing_chunk,
+                                      grouped_votes=grouped_votes, name='deconv_cap_1_2')(up_1)
 
     # Layer 2 Up: Deconvolutional Capsule
     deconv_cap_2_1 = DeconvCapsuleLayer(kernel_size=4, num_capsule=4, num_atoms=16, upsamp_type='deconv',
-                                        scaling=2, padding='same', routings=3,
+                                        scaling=2, padding='same', routings=3, grouped_votes=grouped_votes,
                                         name='deconv_cap_2_1')(deconv_cap_1_2)
 
     # Skip connection
@@ -68,11 +75,12 @@ def CapsNetR3(input_shape, n_class=2):
 
     # Layer 2 Up: Deconvolutional Capsule
     deconv_cap_2_2 = ConvCapsuleLayer(kernel_size=5, num_capsule=4, num_atoms=16, strides=1,
-                                      padding='same', routings=3, name='deconv_cap_2_2')(up_2)
+                                      padding='same', routings=3, routing_chunk=routing_chunk,
+                                      grouped_votes=grouped_votes, name='deconv_cap_2_2')(up_2)
 
     # Layer 3 Up: Deconvolutional Capsule
     deconv_cap_3_1 = DeconvCapsuleLayer(kernel_size=4, num_capsule=2, num_atoms=16, upsamp_type='deconv',
-                                        scaling=2, padding='same', routings=3,
+                                        scaling=2, padding='same', routings=3, grouped_votes=grouped_votes,
                                         name='deconv_cap_3_1')(deconv_cap_2_2)
 
     # Skip connection
@@ -80,11 +88,16 @@ def CapsNetR3(input_shape, n_class=2):
 
     # Layer 4: Convolutional Capsule: 1x1
     seg_caps = ConvCapsuleLayer(kernel_size=1, num_capsule=1, num_atoms=16, strides=1, padding='same',
-                                routings=3, name='seg_caps')(up_3)
+                                routings=3, routing_chunk=routing_chunk,
+                                grouped_votes=grouped_votes, name='seg_caps')(up_3)
 
     # Layer 4: This is an auxiliary layer to replace each capsule with its length. Just to match the true label's shape.
     out_seg = Length(num_classes=n_class, seg=True, name='out_seg')(seg_caps)
 
+    if seg_only:
+        # Inference model without the reconstruction decoder, predict returns the segmentation alone
+        return tf.keras.models.Model(inputs=x, outputs=out_seg)
+
     # Decoder network.
     _, H, W, C, A = seg_caps.get_shape()
     y = tf.keras.layers.Input(shape=input_shape[:-1]+(1,))
@@ -119,7 +132,7 @@ def CapsNetR3(input_shape, n_class=2):
     return train_model, eval_model, manipulate_model
 
 
-def CapsNetR4(input_shape, n_class=2):
+def CapsNetR4(input_shape, n_class=2, routing_chunk=None, grouped_votes=False, seg_only=False):
     x = tf.keras.layers.Input(shape=input_shape)
 
     # Layer 1: Just a conventional Conv2D layer
@@ -131,11 +144,13 @@ def CapsNetR4(input_shape, n_class=2):
 
     # Layer 1: Primary Capsule: Conv cap with routing 1
     primary_caps = ConvCapsuleLayer(kernel_size=5, num_capsule=2, num_atoms=16, strides=2, padding='same',
-                                    routings=1, name='primarycaps')(conv1_reshaped)
+                                    routings=1, routing_chunk=routing_chunk,
+                                    grouped_votes=grouped_votes, name='primarycaps')(conv1_reshaped)
 
     # Layer 2: Convolutional Capsule
     conv_cap_2_1 = ConvCapsuleLayer(kernel_size=5, num_capsule=4, num_atoms=16, strides=1, padding='same',
-                                    routings=3, name='conv_cap_2_1')(primary_caps)
+                                    routings=3, routing_chunk=routing_chunk,
+                                    grouped_votes=grouped_votes, name='conv_cap_2_1')(primary_caps)
 
     # Layer 2: Convolutional Capsule
     # conv_cap_2_2 = ConvCapsuleLayer(kernel_size=5, num_capsule=4, num_atoms=32, strides=2, padding='same',
@@ -175,11 +190,12 @@ def CapsNetR4(input_shape, n_class=2):
 
     # Layer 2 Up: Deconvolutional Capsule
     deconv_cap_2_2 = ConvCapsuleLayer(kernel_size=5, num_capsule=4, num_atoms=16, strides=1,
-                                      padding='same', routings=3, name='deconv_cap_2_2')(conv_cap_2_1)
+                                      padding='same', routings=3, routing_chunk=routing_chunk,
+                                      grouped_votes=grouped_votes, name='deconv_cap_2_2')(conv_cap_2_1)
 
     # Layer 3 Up: Deconvolutional Capsule
     deconv_cap_3_1 = DeconvCapsuleLayer(kernel_size=4, num_capsule=2, num_atoms=16, upsamp_type='deconv',
-                                        scaling=2, padding='same', routings=3,
+                                        scaling=2, padding='same', routings=3, grouped_votes=grouped_votes,
                                         name='deconv_cap_3_1')(deconv_cap_2_2)
 
     # Skip connection
@@ -187,11 +203,16 @@ def CapsNetR4(input_shape, n_class=2):
 
     # Layer 4: Convolutional Capsule: 1x1
     seg_caps = ConvCapsuleLayer(kernel_size=1, num_capsule=1, num_atoms=16, strides=1, padding='same',
-                                routings=3, name='seg_caps')(up_3)
+                                routings=3, routing_chunk=routing_chunk,
+                                grouped_votes=grouped_votes, name='seg_caps')(up_3)
 
     # Layer 4: This is an auxiliary layer to replace each capsule with its length. Just to match the true label's shape.
     out_seg = Length(num_classes=n_class, seg=True, name='out_seg')(seg_caps)
 
+    if seg_only:
+        # Inference model without the reconstruction decoder, predict returns the segmentation alone
+        return tf.keras.models.Model(inputs=x, outputs=out_seg)
+
     # Decoder network.
     _, H, W, C, A = seg_caps.get_shape()
     y = tf.keras.layers.Input(shape=input_shape[:-1]+(1,))
@@ -226,7 +247,7 @@ def CapsNetR4(input_shape, n_class=2):
     return train_model, eval_model, manipulate_model
 
 
-def CapsNetBasic(input_shape, n_class=2):
+def CapsNetBasic(input_shape, n_class=2, routing_chunk=None, grouped_votes=False):
     x = tf.keras.layers.Input(shape=input_shape)
 
     # Layer 1: Just a conventional Conv2D layer
@@ -238,11 +259,13 @@ def CapsNetBasic(input_shape, n_class=2):
 
     # Layer 1: Primary Capsule: Conv cap with routing 1
     primary_caps = ConvCapsuleLayer(kernel_size=5, num_capsule=8, num_atoms=32, strides=1, padding='same',
-                                    routings=1, name='primarycaps')(conv1_reshaped)
+                                    routings=1, routing_chunk=routing_chunk,
+                                    grouped_votes=grouped_votes, name='primarycaps')(conv1_reshaped)
 
     # Layer 4: Convolutional Capsule: 1x1
     seg_caps = ConvCapsuleLayer(kernel_size=1, num_capsule=1, num_atoms=16, strides=1, padding='same',
-                                routings=3, name='seg_caps')(primary_caps)
+                                routings=3, routing_chunk=routing_chunk,
+                                grouped_votes=grouped_votes, name='seg_caps')(primary_caps)
 
     # Layer 4: This is an auxiliary layer to replace each capsule with its length. Just to match the true label's shape.
     out_seg = Length(num_classes=n_class, seg=True, name='out_seg')(seg_caps)
@@ -278,3 +301,11 @@ def CapsNetBasic(input_shape, n_class=2):
     manipulate_model = tf.keras.models.Model(inputs=[x, y, noise], outputs=shared_decoder(masked_noised_y))
 
     return train_model, eval_model, manipulate_model
+
+
+def load_seg_model(model_path, input_shape, builder=CapsNetR3, **kwargs):
+    # Segmentation only model of builder (CapsNetR3 / CapsNetR4) with the weights of a training checkpoint (full model
+    # or weights .hdf5), matched by layer name so the decoder weights are skipped
+    model = builder(input_shape, seg_only=True, **kwargs)
+    model.load_weights(model_path, by_name=True)
+    return model
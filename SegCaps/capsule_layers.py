@@ -9,7 +9,6 @@ This file contains the definitions of the various capsule layers and dynamic rou
 '''
 
 import tensorflow as tf
-import numpy as np
 
 
 def conv_output_length(input_length, filter_size,
@@ -29,6 +28,70 @@ def conv_output_length(input_length, filter_size,
     return (output_length + stride - 1) // stride
 
 
+def same_padding(input_length, filter_size, stride):
+    # [before, after] zero padding of a 'same' convolution, as tf.nn.conv2d splits it
+    output_length = (input_length + stride - 1) // stride
+    total = max((output_length - 1) * stride + filter_size - input_length, 0)
+    return [total // 2, total - total // 2]
+
+
+def transpose_conv_phases(input_length, output_length, kernel_size, stride, padding):
+    # For every output phase (position % stride) of a transposed convolution: the kernel taps reaching it, in the
+    # order of a stride 1 correlation over the input, and the input offset of the first one
+    if padding == 'same':
+        pad = max((input_length - 1) * stride + kernel_size - output_length, 0) // 2
+    else:
+        pad = 0
+    phases = []
+    for phase in range(stride):
+        taps = [t for t in range(kernel_size) if (phase + pad - t) % stride == 0][::-1]
+        phases.append((taps, (phase + pad - taps[0]) // stride))
+    return phases
+
+
+def grouped_conv2d_transpose(inputs, kernel, output_size, strides, padding):
+    # conv2d_transpose of a channels_last input with a grouped conv2d kernel [k, k, in / groups, out]. TF has no
+    # grouped transposed convolution, it is computed as one stride 1 grouped convolution per output phase with the
+    # kernel taps of that phase, the phases are then interleaved.
+    _, height, width, _ = inputs.get_shape()
+    kernel_size = kernel.get_shape()[0]
+    out_height, out_width = output_size
+    rows = -(-out_height // strides)
+    cols = -(-out_width // strides)
+    phases = []
+    for taps_h, offset_h in transpose_conv_phases(height, out_height, kernel_size, strides, padding):
+        phase_row = []
+        for taps_w, offset_w in transpose_conv_phases(width, out_width, kernel_size, strides, padding):
+            sub_kernel = tf.gather(tf.gather(kernel, taps_h, axis=0), taps_w, axis=1)
+            # input rows offset_h .. offset_h + rows + len(taps_h) - 2 (and columns), zeros outside the input
+            length_h = rows + len(taps_h) - 1
+            length_w = cols + len(taps_w) - 1
+            pad_h = [max(-offset_h, 0), max(offset_h + length_h - height, 0)]
+            pad_w = [max(-offset_w, 0), max(offset_w + length_w - width, 0)]
+            padded = tf.pad(inputs, [[0, 0], pad_h, pad_w, [0, 0]])
+            top = offset_h + pad_h[0]
+            left = offset_w + pad_w[0]
+            phase_row.append(tf.nn.conv2d(padded[:, top:top + length_h, left:left + length_w], sub_kernel, 1, 'VALID'))
+        phases.append(tf.stack(phase_row, axis=3))
+    # [batch, rows, strides, cols, strides, channels] -> [batch, rows * strides, cols * strides, channels]
+    outputs = tf.stack(phases, axis=2)
+    shape = tf.keras.backend.shape(outputs)
+    outputs = tf.keras.backend.reshape(outputs, [shape[0], rows * strides, cols * strides, shape[-1]])
+    return outputs[:, :out_height, :out_width]
+
+
+def grouped_votes(conv, input_num_capsule, num_capsule, num_atoms):
+    # [batch, height, width, input_num_capsule, num_capsule, num_atoms] votes and the logit shape from the output
+    # of a convolution with a group per input capsule
+    conv_shape = tf.keras.backend.shape(conv)
+    _, conv_height, conv_width, _ = conv.get_shape()
+    votes = tf.keras.backend.reshape(conv, [conv_shape[0], conv_shape[1], conv_shape[2],
+                                            input_num_capsule, num_capsule, num_atoms])
+    votes.set_shape((None, conv_height, conv_width, input_num_capsule, num_capsule, num_atoms))
+    logit_shape = tf.keras.backend.stack([conv_shape[0], conv_shape[1], conv_shape[2], input_num_capsule, num_capsule])
+    return votes, logit_shape
+
+
 def deconv_length(dim_size, stride_size, kernel_size, padding,
                   output_padding, dilation=1):
     assert padding in {'same', 'valid', 'full'}
@@ -137,7 +200,7 @@ class Mask(tf.keras.layers.Layer):
 
 class ConvCapsuleLayer(tf.keras.layers.Layer):
     def __init__(self, kernel_size, num_capsule, num_atoms, strides=1, padding='same', routings=3,
-                 kernel_initializer='he_normal', **kwargs):
+                 kernel_initializer='he_normal', routing_chunk=None, grouped_votes=False, **kwargs):
         super(ConvCapsuleLayer, self).__init__(**kwargs)
         self.kernel_size = kernel_size
         self.num_capsule = num_capsule
@@ -146,6 +209,13 @@ class ConvCapsuleLayer(tf.keras.layers.Layer):
         self.padding = padding
         self.routings = routings
         self.kernel_initializer = tf.keras.initializers.get(kernel_initializer)
+        # Output rows routed at a time, None routes the whole map at once. Routing is per pixel so the chunked
+        # result is the same, only the votes and logits of one band of rows are held in memory at a time.
+        self.routing_chunk = routing_chunk
+        # Votes from a single grouped convolution over the channels_last input (one group per input capsule, all
+        # sharing W) instead of folding the capsules into the batch. Same weights; every sample only votes with its
+        # own capsules, the folded path mixes the samples of a batch larger than 1.
+        self.grouped_votes = grouped_votes
 
     def build(self, input_shape):
         assert len(input_shape) == 5, "The input Tensor should have shape=[None, input_height, input_width," \
@@ -168,15 +238,56 @@ class ConvCapsuleLayer(tf.keras.layers.Layer):
         self.built = True
 
     def call(self, input_tensor, training=None):
-
+        conv_height = conv_output_length(self.input_height, self.kernel_size, self.padding, self.strides)
+        if not self.routing_chunk or conv_height is None or conv_height <= self.routing_chunk:
+            return self._route(input_tensor, self.padding)
+
+        # Explicit 'same' padding, then bands of input rows (with their kernel overlap) convolved with 'valid'
+        if self.padding == 'same':
+            input_tensor = tf.pad(input_tensor, [[0, 0], same_padding(self.input_height, self.kernel_size, self.strides),
+                                                 same_padding(self.input_width, self.kernel_size, self.strides),
+                                                 [0, 0], [0, 0]])
+        route = lambda band: self._route(band, 'valid')
+        if training:
+            # keep only the band inputs for the backward pass, the votes and logits are computed again
+            route = tf.recompute_grad(route)
+        activations = []
+        for top in range(0, conv_height, self.routing_chunk):
+            bottom = min(top + self.routing_chunk, conv_height)
+            # one band after the other, so that their routing tensors are not alive at the same time
+            with tf.control_dependencies(activations[-1:]):
+                band = input_tensor[:, top * self.strides:(bottom - 1) * self.strides + self.kernel_size]
+            activations.append(route(band))
+
+        return tf.concat(activations, axis=1)
+
+    def _route(self, input_tensor, padding):
+        if self.grouped_votes:
+            input_shape = tf.keras.backend.shape(input_tensor)
+            input_tensor_reshaped = tf.keras.backend.reshape(input_tensor, [
+                input_shape[0], input_shape[1], input_shape[2], self.input_num_capsule * self.input_capsule_depth])
+            kernel = tf.keras.backend.tile(self.W, [1, 1, 1, self.input_num_capsule])
+            conv = tf.nn.conv2d(input_tensor_reshaped, kernel, self.strides, padding.upper())
+            votes, logit_shape = grouped_votes(conv, self.input_num_capsule, self.num_capsule, self.num_atoms)
+            return update_routing(
+                votes=votes,
+                biases=self.b,
+                logit_shape=logit_shape,
+                num_dims=6,
+                input_dim=self.input_num_capsule,
+                output_dim=self.num_capsule,
+                num_routing=self.routings,
+                input_axis=3)
+
+        _, input_height, input_width, _, _ = input_tensor.get_shape()
         input_transposed = tf.transpose(input_tensor, [3, 0, 1, 2, 4])
         input_shape = tf.keras.backend.shape(input_transposed)
         input_tensor_reshaped = tf.keras.backend.reshape(input_transposed, [
-            input_shape[0] * input_shape[1], self.input_height, self.input_width, self.input_capsule_depth])
-        input_tensor_reshaped.set_shape((None, self.input_height, self.input_width, self.input_capsule_depth))
+            input_shape[0] * input_shape[1], input_height, input_width, self.input_capsule_depth])
+        input_tensor_reshaped.set_shape((None, input_height, input_width, self.input_capsule_depth))
 
         conv = tf.keras.backend.conv2d(input_tensor_reshaped, self.W, (self.strides, self.strides),
-                        padding=self.padding, data_format='channels_last')
+                        padding=padding, data_format='channels_last')
 
         votes_shape = tf.keras.backend.shape(conv)
         _, conv_height, conv_width, _ = conv.get_shape()
@@ -223,7 +334,9 @@ class ConvCapsuleLayer(tf.keras.layers.Layer):
             'strides': self.strides,
             'padding': self.padding,
             'routings': self.routings,
-            'kernel_initializer': tf.keras.initializers.serialize(self.kernel_initializer)
+            'kernel_initializer': tf.keras.initializers.serialize(self.kernel_initializer),
+            'routing_chunk': self.routing_chunk,
+            'grouped_votes': self.grouped_votes
         }
         base_config = super(ConvCapsuleLayer, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
@@ -231,7 +344,7 @@ class ConvCapsuleLayer(tf.keras.layers.Layer):
 
 class DeconvCapsuleLayer(tf.keras.layers.Layer):
     def __init__(self, kernel_size, num_capsule, num_atoms, scaling=2, upsamp_type='deconv', padding='same', routings=3,
-                 kernel_initializer='he_normal', **kwargs):
+                 kernel_initializer='he_normal', grouped_votes=False, **kwargs):
         super(DeconvCapsuleLayer, self).__init__(**kwargs)
         self.kernel_size = kernel_size
         self.num_capsule = num_capsule
@@ -241,6 +354,10 @@ class DeconvCapsuleLayer(tf.keras.layers.Layer):
         self.padding = padding
         self.routings = routings
         self.kernel_initializer = tf.keras.initializers.get(kernel_initializer)
+        # Grouped vote convolution as in ConvCapsuleLayer, 'deconv' runs one grouped convolution per output phase
+        self.grouped_votes = grouped_votes
+        if grouped_votes and upsamp_type == 'subpix':
+            raise NotImplementedError('Grouped votes are not implemented for "subpix" upsampling')
 
     def build(self, input_shape):
         assert len(input_shape) == 5, "The input Tensor should have shape=[None, input_height, input_width," \
@@ -275,6 +392,9 @@ class DeconvCapsuleLayer(tf.keras.layers.Layer):
         self.built = True
 
     def call(self, input_tensor, training=None):
+        if self.grouped_votes:
+            return self._grouped_route(input_tensor)
+
         input_transposed = tf.transpose(input_tensor, [3, 0, 1, 2, 4])
         input_shape = tf.keras.backend.shape(input_transposed)
         input_tensor_reshaped = tf.keras.backend.reshape(input_transposed, [
@@ -323,6 +443,34 @@ class DeconvCapsuleLayer(tf.keras.layers.Layer):
 
         return activations
 
+    def _grouped_route(self, input_tensor):
+        input_shape = tf.keras.backend.shape(input_tensor)
+        input_tensor_reshaped = tf.keras.backend.reshape(input_tensor, [
+            input_shape[0], self.input_height, self.input_width, self.input_num_capsule * self.input_capsule_depth])
+
+        if self.upsamp_type == 'resize':
+            upsamp = tf.keras.backend.resize_images(input_tensor_reshaped, self.scaling, self.scaling, 'channels_last')
+            kernel = tf.keras.backend.tile(self.W, [1, 1, 1, self.input_num_capsule])
+            outputs = tf.nn.conv2d(upsamp, kernel, 1, self.padding.upper())
+        else:
+            out_height = deconv_length(self.input_height, self.scaling, self.kernel_size, self.padding, None)
+            out_width = deconv_length(self.input_width, self.scaling, self.kernel_size, self.padding, None)
+            kernel = tf.keras.backend.tile(tf.transpose(self.W, [0, 1, 3, 2]), [1, 1, 1, self.input_num_capsule])
+            outputs = grouped_conv2d_transpose(input_tensor_reshaped, kernel, (out_height, out_width), self.scaling,
+                                               self.padding)
+
+        votes, logit_shape = grouped_votes(outputs, self.input_num_capsule, self.num_capsule, self.num_atoms)
+
+        return update_routing(
+            votes=votes,
+            biases=self.b,
+            logit_shape=logit_shape,
+            num_dims=6,
+            input_dim=self.input_num_capsule,
+            output_dim=self.num_capsule,
+            num_routing=self.routings,
+            input_axis=3)
+
     def compute_output_shape(self, input_shape):
         output_shape = list(input_shape)
 
@@ -342,55 +490,37 @@ class DeconvCapsuleLayer(tf.keras.layers.Layer):
             'padding': self.padding,
             'upsamp_type': self.upsamp_type,
             'routings': self.routings,
-            'kernel_initializer': tf.keras.initializers.serialize(self.kernel_initializer)
+            'kernel_initializer': tf.keras.initializers.serialize(self.kernel_initializer),
+            'grouped_votes': self.grouped_votes
         }
         base_config = super(DeconvCapsuleLayer, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
 
 
 def update_routing(votes, biases, logit_shape, num_dims, input_dim, output_dim,
-                    num_routing):
-    if num_dims == 6:
-        votes_t_shape = [5, 0, 1, 2, 3, 4]
-        r_t_shape = [1, 2, 3, 4, 5, 0]
-    elif num_dims == 4:
-        votes_t_shape = [3, 0, 1, 2]
-        r_t_shape = [1, 2, 3, 0]
-    else:
+                    num_routing, input_axis=1):
+    # votes: [batch, input_dim, ..., output_dim, num_atoms] (input_dim at input_axis), returns the activation of the
+    # last iteration [batch, ..., output_dim, num_atoms]. The fixed number of iterations is unrolled and the weighted sum over the
+    # input capsules and the agreement are taken by broadcasting, in the same order of operations as the former
+    # while_loop (identical outputs) but without its transposes, tiles and TensorArray.
+    if num_dims not in (4, 6):
         raise NotImplementedError('Not implemented')
 
-    votes_trans = tf.transpose(votes, votes_t_shape)
-    _, _, _, height, width, caps = votes_trans.get_shape()
-
-    def _body(i, logits, activations):
-        """Routing while loop."""
-        # route: [batch, input_dim, output_dim, ...]
-        route = tf.nn.softmax(logits, axis=-1)
-        preactivate_unrolled = route * votes_trans
-        preact_trans = tf.transpose(preactivate_unrolled, r_t_shape)
-        preactivate = tf.reduce_sum(preact_trans, axis=1) + biases
+    # softmax of all-zero logits
+    route = tf.fill(logit_shape, 1.0 / output_dim)
+    logits = None
+    for i in range(num_routing):
+        if logits is not None:
+            # route: [batch, input_dim, ..., output_dim]
+            route = tf.nn.softmax(logits, axis=-1)
+        preactivate = tf.reduce_sum(tf.expand_dims(route, -1) * votes, axis=input_axis) + biases
         activation = _squash(preactivate)
-        activations = activations.write(i, activation)
-        act_3d = tf.keras.backend.expand_dims(activation, 1)
-        tile_shape = np.ones(num_dims, dtype=np.int32).tolist()
-        tile_shape[1] = input_dim
-        act_replicated = tf.tile(act_3d, tile_shape)
-        distances = tf.reduce_sum(votes * act_replicated, axis=-1)
-        logits += distances
-        return (i + 1, logits, activations)
-
-    activations = tf.TensorArray(
-      dtype=tf.float32, size=num_routing, clear_after_read=False)
-    logits = tf.fill(logit_shape, 0.0)
-
-    i = tf.constant(0, dtype=tf.int32)
-    _, logits, activations = tf.while_loop(
-      lambda i, logits, activations: i < num_routing,
-      _body,
-      loop_vars=[i, logits, activations],
-      swap_memory=True)
-
-    return tf.keras.backend.cast(activations.read(num_routing - 1), dtype='float32')
+        if i == num_routing - 1:
+            break
+        distances = tf.reduce_sum(votes * tf.expand_dims(activation, input_axis), axis=-1)
+        logits = distances if logits is None else logits + distances
+
+    return tf.keras.backend.cast(activation, dtype='float32')
 
 
 def _squash(input_tensor):
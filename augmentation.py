@@ -0,0 +1,164 @@
+import numpy as np
+import cv2
+from pipeline_stats import timer_of
+
+
+class BatchAugmenter(object):
+    # Random flip / zoom / shift / rotation / shear / brightness / salt-pepper noise for a batch of image + mask pairs.
+    # Every chance is "1 in N" like the original generators (0 disables the transform). All random values of a batch
+    # are drawn at once, the geometric transforms of a sample are composed into a single affine matrix and applied
+    # to image and mask together by one cv2.warpAffine; samples without a geometric transform are not warped at all.
+    def __init__(self, flip=100, zoom=100, zoom_range=(0.7, 1.3), shift=1000, shift_range=1.5,
+                 rotation=100, rotation_range=45, brightness=100, brightness_range=(0.8, 1.1),
+                 shear=100, shear_range=45, noise=100):
+        self.flip = flip
+        self.zoom = zoom
+        self.zoom_range = zoom_range
+        self.shift = shift
+        self.shift_range = shift_range
+        self.rotation = rotation
+        self.rotation_range = rotation_range
+        self.brightness = brightness
+        self.brightness_range = brightness_range
+        self.shear = shear
+        self.shear_range = shear_range
+        self.noise = noise
+
+    @staticmethod
+    def _chance(one_in, n, rng):
+        if not one_in:
+            return np.zeros(n, dtype=bool)
+        return rng.randint(0, one_in, size=n) == 0
+
+    def draw(self, n, rng=np.random):
+        # random decisions and values for n samples, the values are drawn even when the transform is not selected
+        return {
+            'flip_h': self._chance(self.flip, n, rng),
+            'flip_v': self._chance(self.flip, n, rng),
+            'zoom': self._chance(self.zoom, n, rng),
+            'zx': rng.uniform(self.zoom_range[0], self.zoom_range[1], n),
+            'zy': rng.uniform(self.zoom_range[0], self.zoom_range[1], n),
+            'shift': self._chance(self.shift, n, rng),
+            'tx': rng.uniform(-self.shift_range, self.shift_range, n),
+            'ty': rng.uniform(-self.shift_range, self.shift_range, n),
+            'rotation': self._chance(self.rotation, n, rng),
+            'theta': rng.uniform(-self.rotation_range, self.rotation_range, n),
+            'brightness': self._chance(self.brightness, n, rng),
+            'factor': rng.uniform(self.brightness_range[0], self.brightness_range[1], n),
+            'shear': self._chance(self.shear, n, rng),
+            'shear_angle': rng.uniform(-self.shear_range, self.shear_range, n),
+            'noise': self._chance(self.noise, n, rng),
+        }
+
+    @staticmethod
+    def matrices(params, height, width):
+        # (n, 3, 3) inverse maps (output -> input pixel, cv2 x/y order): flips, then zoom, shift, rotation and shear
+        # about the image centre, in the order the generators used to apply them one after the other.
+        # height and width are scalars or one value per sample.
+        n = len(params['zoom'])
+        eye = np.tile(np.eye(3), (n, 1, 1))
+        height = np.broadcast_to(np.asarray(height, dtype=np.float64), (n,))
+        width = np.broadcast_to(np.asarray(width, dtype=np.float64), (n,))
+        cx, cy = (width - 1) / 2., (height - 1) / 2.
+
+        flip = eye.copy()
+        flip[params['flip_h'], 0, 0] = -1
+        flip[params['flip_h'], 0, 2] = width[params['flip_h']] - 1
+        flip[params['flip_v'], 1, 1] = -1
+        flip[params['flip_v'], 1, 2] = height[params['flip_v']] - 1
+
+        zoom = eye.copy()
+        zoom[:, 0, 0] = np.where(params['zoom'], params['zx'], 1)
+        zoom[:, 1, 1] = np.where(params['zoom'], params['zy'], 1)
+
+        shift = eye.copy()
+        shift[:, 0, 2] = np.where(params['shift'], params['ty'] * width, 0)
+        shift[:, 1, 2] = np.where(params['shift'], params['tx'] * height, 0)
+
+        theta = np.deg2rad(np.where(params['rotation'], params['theta'], 0))
+        rotation = eye.copy()
+        rotation[:, 0, 0] = np.cos(theta)
+        rotation[:, 0, 1] = -np.sin(theta)
+        rotation[:, 1, 0] = np.sin(theta)
+        rotation[:, 1, 1] = np.cos(theta)
+
+        shear_angle = np.deg2rad(np.where(params['shear'], params['shear_angle'], 0))
+        shear = eye.copy()
+        shear[:, 0, 1] = -np.sin(shear_angle)
+        shear[:, 1, 1] = np.cos(shear_angle)
+
+        center = eye.copy()
+        center[:, 0, 2] = cx
+        center[:, 1, 2] = cy
+        reset = eye.copy()
+        reset[:, 0, 2] = -cx
+        reset[:, 1, 2] = -cy
+        return flip @ center @ zoom @ shift @ rotation @ shear @ reset
+
+    def warp(self, img_and_mask, matrix):
+        # cv2.warpAffine handles at most 4 channels at once
+        height, width = img_and_mask.shape[:2]
+        warped = np.empty_like(img_and_mask)
+        for c in range(0, img_and_mask.shape[2], 4):
+            out = cv2.warpAffine(np.ascontiguousarray(img_and_mask[:, :, c:c+4]), matrix[:2], (width, height),
+                                 flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                                 borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+            warped[:, :, c:c+4] = out.reshape(height, width, -1)
+        return warped
+
+    def augment(self, images, labels, rng=np.random, stats=None):
+        # images (h, w, c) and labels (h, w, 1) in [0, 1], as a batch array or lists of arrays of any size.
+        # Returns lists of augmented float32 copies. stats (PipelineStats) gets the time of every branch.
+        timer = timer_of(stats)
+        n = len(images)
+        with timer('augment/draw'):
+            params = self.draw(n, rng)
+            heights = [img.shape[0] for img in images]
+            widths = [img.shape[1] for img in images]
+            matrices = self.matrices(params, heights, widths)
+            geometric = params['zoom'] | params['shift'] | params['rotation'] | params['shear']
+        if stats is not None:
+            for name in ('flip_h', 'flip_v', 'zoom', 'shift', 'rotation', 'shear', 'brightness', 'noise'):
+                stats.count('augment/' + name, int(np.count_nonzero(params[name])))
+        out_images = []
+        out_labels = []
+        for i in range(n):
+            img = np.asarray(images[i], dtype=np.float32)
+            lbl = np.asarray(labels[i], dtype=np.float32)
+            channels = img.shape[2]
+            if geometric[i]:
+                with timer('augment/warp'):
+                    warped = self.warp(np.concatenate((img, lbl), axis=2), matrices[i])
+                    img = warped[:, :, :channels]
+                    lbl = warped[:, :, channels:]
+            else:
+                with timer('augment/flip'):
+                    # flips alone are exact with slicing
+                    if params['flip_h'][i]:
+                        img, lbl = img[:, ::-1], lbl[:, ::-1]
+                    if params['flip_v'][i]:
+                        img, lbl = img[::-1], lbl[::-1]
+                    img, lbl = np.array(img), np.array(lbl)
+            if params['brightness'][i]:
+                with timer('augment/brightness'):
+                    # min-max stretch then scale, like keras apply_brightness_shift on the 0-255 image
+                    img = img - img.min()
+                    if img.max() > 0:
+                        img /= img.max()
+                    img = np.clip(img * params['factor'][i], 0, 1)
+            if params['noise'][i]:
+                with timer('augment/noise'):
+                    img = add_sp_noise(img, rng)
+            out_images.append(np.asarray(img, dtype=np.float32))
+            out_labels.append(lbl)
+        return out_images, out_labels
+
+
+def add_sp_noise(img, rng=np.random):  # Salt Pepper noise
+    max_val = 255
+    prob = rng.randint(5, 150) / 1000
+    randn = rng.randint(-int(max_val*prob), int(max_val*prob), size=(img.shape))
+    if np.max(img) <= 1:
+        randn = randn / 255
+        max_val = 1
+    return np.clip(img + randn, 0, max_val)
@@ -0,0 +1,33 @@
+import numpy as np
+
+
+BATCH_RING_SLOTS = 12       # more than the 10 batches keras queues by default (max_queue_size)
+
+
+class BatchRing(object):
+    # Small ring of preallocated contiguous float32 batches (X, Y and the caps mask y*x), handed out round-robin.
+    # A slot is filled again `slots` batches later, so the consumer must be done with a batch (keras converts it to
+    # tensors as soon as it is dequeued) before that many newer batches are requested.
+    def __init__(self, batch_size, image_shape, label_shape, caps=False, slots=BATCH_RING_SLOTS):
+        self.X = np.empty((slots, batch_size, *image_shape), dtype=np.float32)
+        self.Y = np.empty((slots, batch_size, *label_shape), dtype=np.float32)
+        self.mask = np.empty((slots, batch_size, *image_shape), dtype=np.float32) if caps else None
+        self.slots = slots
+        self.caps = caps
+        self._next = 0
+        self._slot = None
+
+    def next_slot(self):
+        # (X, Y) views of the next slot to fill
+        slot = self._next
+        self._next = (self._next + 1) % self.slots
+        self._slot = slot
+        return self.X[slot], self.Y[slot]
+
+    def output(self):
+        # generator output of the slot just filled: (X, Y), or ([x, y], [y, y*x]) with caps
+        x, y = self.X[self._slot], self.Y[self._slot]
+        if self.caps:
+            mask = np.multiply(y, x, out=self.mask[self._slot])
+            return ([x, y], [y, mask])
+        return x, y
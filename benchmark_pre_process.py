@@ -0,0 +1,135 @@
+import argparse
+import json
+import os
+import platform
+import time
+import tracemalloc
+import numpy as np
+import pre_process as P
+
+
+GEOMETRIES = {                  # (height, width)
+    'DRIVE': (584, 565),
+    'STARE': (605, 700),
+    'CHASE': (960, 999),
+    'HRF': (2336, 3504),
+}
+STACK_SIZE = 8                  # images in the synthetic stacks
+PATCH_SIZE = (256, 256)         # (height, width)
+STRIDE_SIZE = (128, 128)        # (height, width)
+REPEATS = 3
+BASELINE_FILE = 'benchmarks/pre_process_baseline.json'
+TOLERANCE = 0.25                # slower / more memory than the baseline by this fraction is a regression
+
+
+def synthetic_fundus(height, width, n=1, seed=0):
+    # uint8 (n, height, width, 3) images: noisy reddish disc on a black background, like a fundus photo
+    rng = np.random.RandomState(seed)
+    yy, xx = np.mgrid[:height, :width]
+    fov = ((yy - height/2)**2 + (xx - width/2)**2) < (min(height, width)/2)**2
+    images = rng.randint(0, 256, size=(n, height, width, 3)).astype(np.uint8)
+    images[..., 0] = np.maximum(images[..., 0], 120)
+    images[:, ~fov] = 0
+    return images
+
+
+def benchmark_cases(name, height, width, n):
+    # (function name, callable, number of pixels processed), the inputs are prepared outside of the measurement
+    images = synthetic_fundus(height, width, n)
+    gray = P.rgb2gray(images)
+    gray_cf = np.einsum('kijl->klij', gray)
+    equalized = P.clahe_equalized(gray_cf)
+    padded = P.paint_border_overlap(equalized/255., *PATCH_SIZE, *STRIDE_SIZE, verbose=False)
+    patches = P.extract_ordered_overlap(padded, *PATCH_SIZE, *STRIDE_SIZE, verbose=False)
+    pixels = n * height * width
+    padded_pixels = n * padded.shape[2] * padded.shape[3]
+    return [
+        ('rgb2gray', lambda: P.rgb2gray(images), pixels),
+        ('dataset_normalized', lambda: P.dataset_normalized(gray_cf), pixels),
+        ('clahe_equalized', lambda: P.clahe_equalized(gray_cf), pixels),
+        ('adjust_gamma', lambda: P.adjust_gamma(equalized, 1.2), pixels),
+        ('pre_process_image', lambda: [P.pre_process_image(image) for image in images], pixels),
+        ('pre_process_images', lambda: P.pre_process_images(images), pixels),
+        ('paint_border_overlap', lambda: P.paint_border_overlap(equalized, *PATCH_SIZE, *STRIDE_SIZE, verbose=False), pixels),
+        ('extract_ordered_overlap', lambda: P.extract_ordered_overlap(padded, *PATCH_SIZE, *STRIDE_SIZE, verbose=False), padded_pixels),
+        ('recompone_overlap', lambda: P.recompone_overlap(patches, padded.shape[2], padded.shape[3], *STRIDE_SIZE, verbose=False), padded_pixels),
+    ]
+
+
+def measure(fn, repeats=REPEATS):
+    fn()    # warm up caches (CLAHE object, gamma LUTs, tiling plans)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def run(geometries=GEOMETRIES, stack_size=STACK_SIZE, repeats=REPEATS):
+    results = {}
+    datasets = [(name, shape, 1) for name, shape in geometries.items()]
+    datasets += [(name + '_stack', shape, stack_size) for name, shape in geometries.items() if name != 'HRF']
+    for name, (height, width), n in datasets:
+        for fn_name, fn, pixels in benchmark_cases(name, height, width, n):
+            wall_time, peak = measure(fn, repeats)
+            key = '{}/{}'.format(name, fn_name)
+            results[key] = {
+                'wall_time_s': wall_time,
+                'mpix_per_s': pixels / 1e6 / wall_time,
+                'peak_alloc_mb': peak / 2**20,
+            }
+            print('{:<40} {:>9.2f} ms {:>9.1f} MP/s {:>9.1f} MB'.format(
+                key, wall_time*1000, results[key]['mpix_per_s'], results[key]['peak_alloc_mb']))
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    # list of (key, metric, baseline value, current value) that got worse by more than tolerance
+    regressions = []
+    for key, current in results.items():
+        if key not in baseline:
+            continue
+        for metric in ('wall_time_s', 'peak_alloc_mb'):
+            if current[metric] > baseline[key][metric] * (1 + tolerance):
+                regressions.append((key, metric, baseline[key][metric], current[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pre_process functions on DRIVE/STARE/CHASE/HRF sizes')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='baseline json file')
+    parser.add_argument('--save', action='store_true', help='write the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--skip-hrf', action='store_true', help='skip the 3504x2336 HRF geometry')
+    args = parser.parse_args()
+
+    geometries = {k: v for k, v in GEOMETRIES.items() if not (args.skip_hrf and k == 'HRF')}
+    results = run(geometries, repeats=args.repeats)
+
+    if args.save:
+        if os.path.dirname(args.baseline) and not os.path.isdir(os.path.dirname(args.baseline)):
+            os.makedirs(os.path.dirname(args.baseline))
+        with open(args.baseline, 'w') as f:
+            json.dump({'machine': platform.platform(), 'numpy': np.__version__, 'results': results}, f, indent=1, sort_keys=True)
+        print("Baseline saved to", args.baseline)
+    elif os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for key, metric, old, new in regressions:
+            print("REGRESSION {} {}: {:.4g} -> {:.4g}".format(key, metric, old, new))
+        if regressions:
+            raise SystemExit(1)
+        print("No regressions against", args.baseline)
+    else:
+        print("No baseline at {}, run with --save to create one".format(args.baseline))
+
+
+if __name__ == '__main__':
+    main()
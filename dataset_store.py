@@ -0,0 +1,160 @@
+from glob import glob
+import numpy as np
+import os
+import json
+from PIL import Image
+from tqdm import tqdm
+from pre_process import pre_process_image, save_manifest
+
+
+STORE_VERSION = 2
+INDEX_NAME = 'index.json'
+IMAGES_NAME = 'images.u8'
+LABELS_NAME = 'labels.u8'
+
+
+def store_dir_name(dataset_root_dir, image_dir, label_dir, preprocess=False):
+    return '{}/{}+{}{}.store'.format(dataset_root_dir, image_dir, label_dir, '-pp' if preprocess else '')
+
+
+def label_file(file, image_dir, label_dir):
+    return file.replace(image_dir, label_dir)
+
+
+def source_signature(files, image_dir, label_dir):
+    # {file name: [image size, image mtime, label size, label mtime]}, enough to notice an image or label added,
+    # removed or rewritten
+    signature = {}
+    for file in files:
+        stat = os.stat(file)
+        label = label_file(file, image_dir, label_dir)
+        label_stat = os.stat(label) if os.path.isfile(label) else None
+        signature[os.path.basename(file)] = [stat.st_size, int(stat.st_mtime)] + \
+            ([label_stat.st_size, int(label_stat.st_mtime)] if label_stat else [None, None])
+    return signature
+
+
+def read_pair(file, image_dir, label_dir, preprocess=False):
+    # uint8 (H, W, C) image and (H, W, 1) label, decoded once when the store is built
+    img = np.asarray(Image.open(file))
+    if preprocess:
+        img = pre_process_image(img, return_channel_last_img=True, gamma=1., multi_gamma_channel=False)
+    lbl = np.asarray(Image.open(label_file(file, image_dir, label_dir)))
+    if len(img.shape) == 2:
+        img = np.expand_dims(img, axis=-1)
+    if len(lbl.shape) == 2:
+        lbl = np.expand_dims(lbl, axis=-1)
+    else:
+        lbl = lbl[:, :, :1]
+    return np.asarray(img, dtype=np.uint8), np.asarray(lbl, dtype=np.uint8)
+
+
+def build_store(dataset_root_dir, image_dir, label_dir, image_ext, preprocess=False, store_dir=None):
+    # Concatenates every image (and label) of the split into one raw uint8 file, the index keeps (offset, shape) per entry
+    files = sorted(glob('{}/{}/*.{}'.format(dataset_root_dir, image_dir, image_ext)))
+    if store_dir is None:
+        store_dir = store_dir_name(dataset_root_dir, image_dir, label_dir, preprocess)
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    index = {
+        'version': STORE_VERSION,
+        'preprocess': preprocess,
+        'image_dir': image_dir,
+        'label_dir': label_dir,
+        'sources': source_signature(files, image_dir, label_dir),
+        'names': [],
+        'images': [],
+        'labels': [],
+    }
+    image_offset = 0
+    label_offset = 0
+    with open(os.path.join(store_dir, IMAGES_NAME + '.tmp'), 'wb') as f_img, \
+            open(os.path.join(store_dir, LABELS_NAME + '.tmp'), 'wb') as f_lbl:
+        for file in tqdm(files, desc='Building {}'.format(store_dir)):
+            img, lbl = read_pair(file, image_dir, label_dir, preprocess)
+            f_img.write(np.ascontiguousarray(img).tobytes())
+            f_lbl.write(np.ascontiguousarray(lbl).tobytes())
+            index['names'].append(os.path.basename(file))
+            index['images'].append([image_offset, *img.shape])
+            index['labels'].append([label_offset, *lbl.shape])
+            image_offset += img.size
+            label_offset += lbl.size
+    os.replace(os.path.join(store_dir, IMAGES_NAME + '.tmp'), os.path.join(store_dir, IMAGES_NAME))
+    os.replace(os.path.join(store_dir, LABELS_NAME + '.tmp'), os.path.join(store_dir, LABELS_NAME))
+    # index last, a store without an index is rebuilt
+    save_manifest(index, os.path.join(store_dir, INDEX_NAME))
+    return store_dir
+
+
+def is_store_current(store_dir, files, image_dir, label_dir, preprocess=False):
+    index_path = os.path.join(store_dir, INDEX_NAME)
+    if not os.path.isfile(index_path):
+        return False
+    with open(index_path) as f:
+        index = json.load(f)
+    return index.get('version') == STORE_VERSION and index.get('preprocess') == preprocess and \
+        index.get('image_dir') == image_dir and index.get('label_dir') == label_dir and \
+        index.get('sources') == source_signature(files, image_dir, label_dir)
+
+
+class DatasetStore(object):
+    # Read-only view of a split built by build_store, images and labels are uint8 memmaps shared through the page cache
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_NAME)) as f:
+            self.index = json.load(f)
+        self.names = self.index['names']
+        self._images = self._open(IMAGES_NAME)
+        self._labels = self._open(LABELS_NAME)
+
+    def _open(self, name):
+        path = os.path.join(self.store_dir, name)
+        if os.path.getsize(path) == 0:     # np.memmap cannot map an empty file
+            return np.zeros(0, dtype=np.uint8)
+        return np.memmap(path, dtype=np.uint8, mode='r')
+
+    @staticmethod
+    def _entry(data, entry):
+        offset, shape = entry[0], entry[1:]
+        return data[offset:offset + int(np.prod(shape))].reshape(shape)
+
+    def __len__(self):
+        return len(self.names)
+
+    def image(self, i):
+        return self._entry(self._images, self.index['images'][i])
+
+    def label(self, i):
+        return self._entry(self._labels, self.index['labels'][i])
+
+    def shape(self, i):
+        return tuple(self.index['images'][i][1:])
+
+    def patch_channels(self, input_channel):
+        # channels of the patches cut from the store: every channel of a preprocessed store, at most input_channel
+        # of the stored images otherwise (a grayscale store gives 1 channel whatever input_channel asks)
+        if not len(self):
+            return input_channel
+        if self.index['preprocess']:
+            return self.shape(0)[-1]
+        return min(input_channel, self.shape(0)[-1])
+
+
+def open_store(dataset_root_dir, image_dir, label_dir, image_ext, preprocess=False, store_dir=None):
+    # Builds the store the first time (or when the source images or labels changed) and maps it
+    files = sorted(glob('{}/{}/*.{}'.format(dataset_root_dir, image_dir, image_ext)))
+    if store_dir is None:
+        store_dir = store_dir_name(dataset_root_dir, image_dir, label_dir, preprocess)
+    if not is_store_current(store_dir, files, image_dir, label_dir, preprocess):
+        build_store(dataset_root_dir, image_dir, label_dir, image_ext, preprocess, store_dir)
+    return DatasetStore(store_dir)
+
+
+def main():
+    for dataset_root_dir in ('training_dataset', 'testing_dataset'):
+        store = open_store(dataset_root_dir, 'pre-processed', 'label-1', 'png')
+        print("{}: {} images".format(store.store_dir, len(store)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+import argparse
+import importlib
+from serving import export_model
+
+
+# name -> module with build_model() (the inference model from its training checkpoint) and its export directory
+EXPORTS = {
+    'segcaps': ('test_segcaps', 'SERVING_PATH'),
+    'segcaps_full': ('test_segcaps_full', 'SERVING_PATH'),
+    'bcdu': ('test_bcdu', 'SERVING_PATH'),
+    'eye_classifier': ('EyeClassification.classifier', 'SERVING_DIR'),
+    'eye_filter': ('EyeFilter.classifier', 'SERVING_DIR'),
+}
+
+
+def main():
+    # Writes a SavedModel per model, loaded in place of the checkpoints by the inference scripts and rop_pipeline.
+    # Run it again after changing a checkpoint.
+    parser = argparse.ArgumentParser(description='Export the inference models as SavedModels')
+    parser.add_argument('names', nargs='*', help='models to export among {} (all by default)'.format(', '.join(sorted(EXPORTS))))
+    args = parser.parse_args()
+    unknown = set(args.names) - set(EXPORTS)
+    if unknown:
+        parser.error('unknown models: {}'.format(', '.join(sorted(unknown))))
+    for name in args.names or sorted(EXPORTS):
+        module_name, attribute = EXPORTS[name]
+        module = importlib.import_module(module_name)
+        export_dir = getattr(module, attribute)
+        export_model(module.build_model(), export_dir)
+        print('{} -> {}'.format(name, export_dir))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@ import numpy as np
 from glob import glob
 from PIL import Image
 import os
+from pre_process import dataset_normalized
 
 
 def rgb2gray(rgb):
@@ -13,18 +14,6 @@ def rgb2gray(rgb):
     return bn_imgs
 
 
-def dataset_normalized(imgs):
-    assert (len(imgs.shape)==4)  #4D arrays
-    assert (imgs.shape[1]==1)  #check the channel is 1
-    imgs_normalized = np.empty(imgs.shape)
-    imgs_std = np.std(imgs)
-    imgs_mean = np.mean(imgs)
-    imgs_normalized = (imgs-imgs_mean)/imgs_std
-    for i in range(imgs.shape[0]):
-        imgs_normalized[i] = ((imgs_normalized[i] - np.min(imgs_normalized[i])) / (np.max(imgs_normalized[i])-np.min(imgs_normalized[i])))*255
-    return imgs_normalized
-
-
 def clahe_equalized(imgs):
     assert (len(imgs.shape)==4)  #4D arrays
     assert (imgs.shape[1]==1)  #check the channel is 1
@@ -0,0 +1,189 @@
+import numpy as np
+import multiprocessing as mp
+import queue
+import traceback
+from multiprocessing import shared_memory
+from collections import deque
+from dataset_store import DatasetStore
+from pre_process import _init_worker
+from patch_sampler import crop_patch
+from pipeline_stats import PipelineStats, timer_of
+
+
+RING_SLOTS_PER_WORKER = 2       # batches in flight per worker
+POLL_SECONDS = 1.               # wait on the workers between two checks that they are still alive
+
+
+def to_shared(array):
+    # copies array into a new SharedMemory block, returns the block and its (name, shape, dtype) descriptor
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def attach_shared(descriptor):
+    # (SharedMemory, ndarray view) of a block created by to_shared or SharedRing, no copy
+    name, shape, dtype = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+class SharedDatasetStore(DatasetStore):
+    # DatasetStore whose image and label bytes live in shared memory, every worker maps the same pages
+    def __init__(self, index, images, labels, store_dir=None):
+        self.store_dir = store_dir
+        self.index = index
+        self.names = index['names']
+        self._images = images
+        self._labels = labels
+
+
+class SharedRing(object):
+    # slots x batch_size float32 image and label batches in shared memory, filled by the workers
+    def __init__(self, slots, batch_size, patch_size, channels):
+        self.x_shm = shared_memory.SharedMemory(create=True, size=slots * batch_size * patch_size[0] * patch_size[1] * channels * 4)
+        self.y_shm = shared_memory.SharedMemory(create=True, size=slots * batch_size * patch_size[0] * patch_size[1] * 4)
+        self.x_descriptor = (self.x_shm.name, (slots, batch_size, *patch_size, channels), '<f4')
+        self.y_descriptor = (self.y_shm.name, (slots, batch_size, *patch_size, 1), '<f4')
+        self.X = np.ndarray(self.x_descriptor[1], dtype=np.float32, buffer=self.x_shm.buf)
+        self.Y = np.ndarray(self.y_descriptor[1], dtype=np.float32, buffer=self.y_shm.buf)
+
+    def close(self):
+        del self.X, self.Y
+        for shm in (self.x_shm, self.y_shm):
+            shm.close()
+            shm.unlink()
+
+
+def augmentation_worker(store_descriptor, x_descriptor, y_descriptor, patch_size, channels, data_aug, augmentation, tasks, done, instrument=False):
+    # Fills ring slots: a task is (slot, positions, seed), (slot, timers, counters, None) is sent back once the batch
+    # is written, the timers and counters of the batch are only measured when instrument is set. An exception is sent
+    # back as (slot, None, None, traceback) and stops the worker.
+    _init_worker()
+    index, images_descriptor, labels_descriptor = store_descriptor
+    blocks = []
+    for descriptor in (images_descriptor, labels_descriptor, x_descriptor, y_descriptor):
+        blocks.append(attach_shared(descriptor))
+    store = SharedDatasetStore(index, blocks[0][1], blocks[1][1])
+    X, Y = blocks[2][1], blocks[3][1]
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        slot, positions, seed = task
+        try:
+            rng = np.random.RandomState(seed)
+            stats = PipelineStats() if instrument else None
+            with timer_of(stats)('crop'):
+                patches = [crop_patch(store, position, patch_size, channels) for position in positions]
+            images = [patch[0] for patch in patches]
+            labels = [patch[1] for patch in patches]
+            if data_aug:
+                images, labels = augmentation.augment(images, labels, rng, stats)
+            X[slot] = images
+            Y[slot] = labels
+        except Exception:
+            done.put((slot, None, None, traceback.format_exc()))
+            break
+        if stats is None:
+            done.put((slot, None, None, None))
+        else:
+            done.put((slot, dict(stats.timers), dict(stats.counters), None))
+    del store, X, Y
+    for shm, _ in blocks:
+        shm.close()
+
+
+def parallel_batches(store, sampler, batch_size, channels, data_aug=True, augmentation=None, workers=None,
+                     slots=None, seed=None, start_method=None, buffers=None, stats=None):
+    # Generator of (X, Y) float32 batches built by worker processes, copied into the next slot of buffers (BatchRing)
+    # when given.
+    # The store is copied once into shared memory, workers attach to it and to a ring of batch slots without
+    # per-worker copies. The parent draws the patch positions (PatchSampler stays in one process) and a seed per
+    # batch, batches are yielded in submission order so a fixed seed gives the same stream for any worker count.
+    # stats (PipelineStats) collects the worker timings and the number of batches ready when the trainer asks.
+    # A worker exception (or a worker killed) is raised in the parent as a RuntimeError. channels is cut down to
+    # the channels of the store (DatasetStore.patch_channels).
+    channels = store.patch_channels(channels)
+    workers = workers or mp.cpu_count()
+    slots = slots or RING_SLOTS_PER_WORKER * workers
+    rng = np.random.RandomState(seed)
+    context = mp.get_context(start_method)
+    shared = [to_shared(np.asarray(store._images)), to_shared(np.asarray(store._labels))]
+    store_descriptor = (store.index, shared[0][1], shared[1][1])
+    ring = SharedRing(slots, batch_size, sampler.patch_size, channels)
+    tasks = context.Queue()
+    done = context.Queue()
+    processes = [context.Process(target=augmentation_worker, daemon=True,
+                                 args=(store_descriptor, ring.x_descriptor, ring.y_descriptor, sampler.patch_size,
+                                       channels, data_aug, augmentation, tasks, done, stats is not None))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+
+    def submit(slot):
+        tasks.put((slot, sampler.sample(batch_size, rng), rng.randint(2**31)))
+
+    finished = set()
+
+    def receive(block):
+        # moves the finished slots of the done queue into finished, one message when block is set (waits for it,
+        # raising if a worker failed or died), all the waiting ones otherwise
+        while True:
+            try:
+                message = done.get(timeout=POLL_SECONDS) if block else done.get_nowait()
+            except queue.Empty:
+                if not block:
+                    return
+                dead = [process.exitcode for process in processes if process.exitcode is not None]
+                if dead:
+                    raise RuntimeError("Augmentation worker exited with code {}".format(dead[0]))
+                continue
+            done_slot, timers, counters, error = message
+            if error is not None:
+                raise RuntimeError("Augmentation worker failed:\n" + error)
+            finished.add(done_slot)
+            if stats is not None:
+                stats.merge_times(timers)
+                for name, n in counters.items():
+                    stats.count(name, n)
+            if block:
+                return
+
+    try:
+        pending = deque()
+        for slot in range(slots):
+            submit(slot)
+            pending.append(slot)
+        timer = timer_of(stats)
+        while True:
+            with timer('batch'):
+                slot = pending.popleft()
+                if stats is not None:
+                    # batches ready when the trainer asks (no Queue.qsize, it is missing on macOS)
+                    receive(block=False)
+                    stats.gauge('queue_depth', len(finished))
+                while slot not in finished:
+                    receive(block=True)
+                finished.remove(slot)
+                # copy out, the slot is refilled while the model trains on this batch
+                if buffers is None:
+                    X, Y = np.array(ring.X[slot]), np.array(ring.Y[slot])
+                else:
+                    X, Y = buffers.next_slot()
+                    X[...] = ring.X[slot]
+                    Y[...] = ring.Y[slot]
+                submit(slot)
+                pending.append(slot)
+            yield X, Y
+    finally:
+        for _ in processes:
+            tasks.put(None)
+        for process in processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        ring.close()
+        for shm, _ in shared:
+            shm.close()
+            shm.unlink()
@@ -0,0 +1,140 @@
+import numpy as np
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+from dataset_store import open_store
+from patch_sampler import PatchSampler
+from augmentation import BatchAugmenter
+from pre_process import save_manifest, _init_worker
+
+
+BANK_VERSION = 1
+INDEX_NAME = 'index.json'
+SHARD_SIZE = 1024           # patches per shard
+
+
+def shard_names(k):
+    return 'shard-{:05d}-images.u8'.format(k), 'shard-{:05d}-labels.u8'.format(k)
+
+
+def _build_shard(args):
+    # Crops and augments one shard from its own RandomState([seed, k]), the result does not depend on the worker
+    bank_dir, k, count, params, augmentation = args
+    store = open_store(params['dataset_root_dir'], params['image_dir'], params['label_dir'], params['image_ext'],
+                       preprocess=params['preprocess'])
+    sampler = PatchSampler(store, params['patch_size'], params['negative_fraction'])
+    rng = np.random.RandomState([params['seed'], k])
+    patches = [sampler.crop(position, params['channels']) for position in sampler.sample(count, rng)]
+    images = [patch[0] for patch in patches]
+    labels = [patch[1] for patch in patches]
+    if params['data_aug']:
+        images, labels = augmentation.augment(images, labels, rng)
+    for name, data in zip(shard_names(k), (images, labels)):
+        data = np.clip(np.round(np.array(data) * 255), 0, 255).astype(np.uint8)
+        path = os.path.join(bank_dir, name)
+        data.tofile(path + '.tmp')
+        os.replace(path + '.tmp', path)
+    return k
+
+
+def build_patch_bank(dataset_root_dir, image_dir, label_dir, image_ext, bank_dir, total, patch_size=(64, 64), shard_size=SHARD_SIZE,
+                     input_channel=1, preprocess=False, data_aug=True, augmentation=None, negative_fraction=None, seed=0, workers=None):
+    # Pre-generates total augmented patches of data_generator into fixed size shards of packed uint8 images and
+    # labels, shards are built in parallel. A bank built with the same parameters is reused as is.
+    store = open_store(dataset_root_dir, image_dir, label_dir, image_ext, preprocess=preprocess)   # built once, before the workers
+    channels = store.patch_channels(input_channel)
+    augmentation = augmentation or BatchAugmenter()
+    params = {
+        'dataset_root_dir': dataset_root_dir, 'image_dir': image_dir, 'label_dir': label_dir, 'image_ext': image_ext,
+        'preprocess': preprocess, 'patch_size': list(patch_size), 'channels': channels, 'data_aug': data_aug,
+        'augmentation': vars(augmentation), 'negative_fraction': negative_fraction, 'seed': seed,
+        'sources': store.index['sources'],     # the bank is rebuilt when an image or label of the store changes
+    }
+    counts = [min(shard_size, total - start) for start in range(0, total, shard_size)]
+    index = {'version': BANK_VERSION, 'params': params, 'total': total, 'shard_size': shard_size,
+             'image_shape': [*patch_size, channels], 'label_shape': [*patch_size, 1], 'counts': counts}
+    if not os.path.isdir(bank_dir):
+        os.makedirs(bank_dir)
+    if is_bank_current(bank_dir, index):
+        print("Reusing patch bank", bank_dir)
+        return PatchBank(bank_dir)
+    index_path = os.path.join(bank_dir, INDEX_NAME)
+    if os.path.isfile(index_path):
+        os.remove(index_path)   # a bank without an index is incomplete
+    tasks = [(bank_dir, k, count, params, augmentation) for k, count in enumerate(counts)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        for _ in tqdm(executor.map(_build_shard, tasks), total=len(tasks), desc='Building {}'.format(bank_dir)):
+            pass
+    save_manifest(index, index_path)
+    return PatchBank(bank_dir)
+
+
+def is_bank_current(bank_dir, index):
+    index_path = os.path.join(bank_dir, INDEX_NAME)
+    if not os.path.isfile(index_path):
+        return False
+    with open(index_path) as f:
+        old_index = json.load(f)
+    if old_index != json.loads(json.dumps(index)):
+        return False
+    return all(os.path.isfile(os.path.join(bank_dir, name)) for k in range(len(index['counts'])) for name in shard_names(k))
+
+
+class PatchBank(object):
+    # Read-only access to a bank built by build_patch_bank, shards are memory-mapped when first used
+    def __init__(self, bank_dir):
+        self.bank_dir = bank_dir
+        with open(os.path.join(bank_dir, INDEX_NAME)) as f:
+            self.index = json.load(f)
+        self.counts = self.index['counts']
+        self.shard_size = self.index['shard_size']
+        self.image_shape = tuple(self.index['image_shape'])
+        self.label_shape = tuple(self.index['label_shape'])
+        self._shards = {}
+
+    def __len__(self):
+        return self.index['total']
+
+    def shard(self, k):
+        # (images, labels) uint8 memmaps of shard k
+        if k not in self._shards:
+            image_name, label_name = shard_names(k)
+            self._shards[k] = (
+                np.memmap(os.path.join(self.bank_dir, image_name), dtype=np.uint8, mode='r', shape=(self.counts[k], *self.image_shape)),
+                np.memmap(os.path.join(self.bank_dir, label_name), dtype=np.uint8, mode='r', shape=(self.counts[k], *self.label_shape)),
+            )
+        return self._shards[k]
+
+    def __getitem__(self, i):
+        # uint8 (image, label) of patch i
+        images, labels = self.shard(i // self.shard_size)
+        return images[i % self.shard_size], labels[i % self.shard_size]
+
+    def take(self, indices):
+        # float32 (X, Y) batch of the given patches, in [0, 1]
+        pairs = [self[i] for i in indices]
+        X = np.array([pair[0] for pair in pairs], dtype=np.float32) / 255
+        Y = np.array([pair[1] for pair in pairs], dtype=np.float32) / 255
+        return X, Y
+
+    def load(self):
+        # the whole bank as float32 (X, Y)
+        return self.take(range(len(self)))
+
+    def batches(self, batch_size, shuffle=False, seed=None, caps=False, loop=True):
+        # Streams the bank shard after shard, with shuffle the shard order and the order inside a shard are random
+        # (reads stay local to one shard). Yields (X, Y), or ([x, y], [y, y*x]) with caps, like data_generator.
+        rng = np.random.RandomState(seed)
+        while True:
+            shard_order = rng.permutation(len(self.counts)) if shuffle else range(len(self.counts))
+            order = np.concatenate([k * self.shard_size + (rng.permutation(self.counts[k]) if shuffle else np.arange(self.counts[k]))
+                                    for k in shard_order])
+            for start in range(0, len(order), batch_size):
+                x, y = self.take(order[start:start+batch_size])
+                if caps:
+                    yield ([x, y], [y, y*x])
+                else:
+                    yield x, y
+            if not loop:
+                break
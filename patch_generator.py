@@ -1,158 +1,154 @@
 from matplotlib import pyplot as plt
-from glob import glob
 import numpy as np
-import os
 import cv2
-from PIL import Image
-from tqdm import tqdm
 import tensorflow as tf
-from pre_process import pre_process_image
+from dataset_store import open_store
+from augmentation import BatchAugmenter
+from patch_sampler import PatchSampler
+from parallel_generator import parallel_batches
+from patch_bank import build_patch_bank
+from batch_buffers import BatchRing, BATCH_RING_SLOTS
+from pipeline_stats import timed_dataset, timer_of
 
 
 PATCH_SIZE = (256, 256)       # (height, width)
 TOTAL_PATCHES = 500
 # IMG_MAX_HEIGHT = 800
 # IMG_MIN_HEIGHT = 500
-
-
-def add_sp_noise(img):  # Salt Pepper noise
-    max_val = 255
-    prob = np.random.randint(5, 150) / 1000
-    randn = np.random.randint(-int(max_val*prob), int(max_val*prob), size=(img.shape))
-    if np.max(img) <= 1:
-        randn = randn / 255
-        max_val = 1
-    return np.clip(img + randn, 0, max_val)
-
-
-def data_generator(dataset_root_dir, image_dir, label_dir, image_ext, batch_size, patch_size=(64, 64), input_channel=1, preprocess=False, data_aug=True, caps=False):
-    files = glob('{}/{}/*.{}'.format(dataset_root_dir, image_dir, image_ext))
-    images = []
-    labels = []
-    # TODO: Get Dynamic Channel Size
-    channels = input_channel
-    for file in files:
-        img = np.asarray(Image.open(file))
-        if preprocess:
-            img = pre_process_image(img, return_channel_last_img=True, gamma=1., multi_gamma_channel=False)
-            channels = img.shape[-1]
-        lbl = np.asarray(Image.open(file.replace(image_dir, label_dir)))
-        if np.max(img) > 1:
-            data_img = np.array(img / 255, dtype=np.float32)
-        if np.max(lbl) > 1:
-            data_lbl = np.array(lbl / 255, dtype=np.float32)
-        if len(data_img.shape) == 2:
-            data_img = np.expand_dims(data_img, axis=-1)
-        else:
-            data_img = data_img[:, :, :channels]
-        if len(data_lbl.shape) == 2:
-            data_lbl = np.expand_dims(data_lbl, axis=-1)
-        else:
-            data_lbl = data_lbl[:, :, :1]
-        images.append(data_img)
-        labels.append(data_lbl)
+PATCH_AUGMENTATION = BatchAugmenter()       # chances and ranges of data_generator
+FULL_IMAGE_AUGMENTATION = BatchAugmenter(flip=10, zoom=10, shift=100, rotation=10, rotation_range=180,
+                                         brightness=10, shear=100, shear_range=60, noise=50)
+FULL_IMAGE_CACHE_MARGIN = 0.1  # cached full images are image_size * (1 + margin), a little headroom for the final resize
+
+
+def keep_sample(patch_lbl, rng=np.random):
+    # Can be ignored
+    return not (np.sum(patch_lbl) == 0 and rng.randint(0, 100) > 50)    # 50% chance of selecting all negative sample
+
+
+def random_patch(sampler, channels, data_aug=True, rng=np.random, augmentation=PATCH_AUGMENTATION, stats=None):
+    # single sample version of data_generator, (patch_img, patch_lbl)
+    with timer_of(stats)('crop'):
+        patch_img, patch_lbl = sampler.crop(sampler.sample(1, rng)[0], channels)
+    if data_aug:
+        images, labels = augmentation.augment([patch_img], [patch_lbl], rng, stats)
+        patch_img, patch_lbl = images[0], labels[0]
+    return patch_img, patch_lbl
+
+
+def count_sampler(stats, sampler):
+    # the sampler never draws a too small image or an unwanted negative patch, the causes are reported as 0 rejected
+    if stats is not None:
+        stats.count('excluded_images/too_small_image', len(sampler.excluded))
+        stats.count('rejected/too_small_image', 0)
+        stats.count('rejected/negative_patch', 0)
+
+
+def data_generator(dataset_root_dir, image_dir, label_dir, image_ext, batch_size, patch_size=(64, 64), input_channel=1, preprocess=False, data_aug=True, caps=False, store_dir=None,
+                   augmentation=PATCH_AUGMENTATION, negative_fraction=None, workers=0, seed=None, buffer_slots=BATCH_RING_SLOTS, stats=None,
+                   sampler=None):
+    # images and labels are read from the memory-mapped uint8 store, only the sampled patch is converted to float.
+    # The sampler picks the positive / negative mix up front, so every cropped and augmented patch is used.
+    # workers > 0 builds the batches in that many processes sharing the images through shared memory.
+    # Batches are written into a ring of buffer_slots preallocated buffers, a yielded batch is overwritten
+    # buffer_slots batches later. stats (PipelineStats) turns on the input pipeline instrumentation.
+    # sampler replaces the default PatchSampler of the store, e.g. a HardExampleSampler fed by hard_example_callback.
+    store = open_store(dataset_root_dir, image_dir, label_dir, image_ext, preprocess=preprocess, store_dir=store_dir)
+    if sampler is None:
+        sampler = PatchSampler(store, patch_size, negative_fraction)
+    else:
+        store = sampler.store
+    channels = store.patch_channels(input_channel)
+
+    buffers = BatchRing(batch_size, (*patch_size, channels), (*patch_size, 1), caps, buffer_slots)
+    count_sampler(stats, sampler)
+    timer = timer_of(stats)
+
+    if workers:
+        for _ in parallel_batches(store, sampler, batch_size, channels, data_aug, augmentation, workers, seed=seed, buffers=buffers, stats=stats):
+            if stats is not None:
+                stats.count('samples', batch_size)
+                stats.count('batches')
+            yield buffers.output()
+    rng = np.random.RandomState(seed) if seed is not None else np.random
 
     while True:
-        X = []
-        Y = []
-        b = 0
-        while b < batch_size:
-            index = np.random.randint(len(images))
-            image = images[index]
-            img_shp = image.shape
-            label = labels[index]
-            if img_shp[0] <= patch_size[0] or img_shp[1] <= patch_size[1]:
-                continue
-            rnd_height = np.random.randint(img_shp[0] - patch_size[0])
-            rnd_width = np.random.randint(img_shp[1] - patch_size[1])
-            patch_img = image[rnd_height:rnd_height+patch_size[0], rnd_width:rnd_width+patch_size[1], ...]
-            patch_lbl = label[rnd_height:rnd_height+patch_size[0], rnd_width:rnd_width+patch_size[1], ...]
+        with timer('batch'):
+            X, Y = buffers.next_slot()
+            with timer('crop'):
+                patches = [sampler.crop(position, channels) for position in sampler.sample(batch_size, rng)]
+            images = [patch[0] for patch in patches]
+            labels = [patch[1] for patch in patches]
             if data_aug:
-                img_and_mask = np.concatenate((patch_img, patch_lbl), axis=2)
-                # Horizontal Flipping
-                if np.random.randint(0, 100) == 0:
-                    img_and_mask = img_and_mask[:, ::-1, ...]
-                # Vertical Flipping
-                if np.random.randint(0, 100) == 0:
-                    img_and_mask = img_and_mask[::-1, :, ...]
-
-                if np.random.randint(0, 100) == 0:
-                    img_and_mask = tf.keras.preprocessing.image.random_zoom(
-                        img_and_mask, zoom_range=(0.7, 1.3),
-                        row_axis=0, col_axis=1, channel_axis=2,
-                        fill_mode='constant', cval=0.0
-                    )
-                if np.random.randint(0, 1000) == 0:
-                    img_and_mask = tf.keras.preprocessing.image.random_shift(        # very low prob
-                        img_and_mask, wrg=1.5, hrg=1.5,
-                        row_axis=0, col_axis=1, channel_axis=2,
-                        fill_mode='constant', cval=0.0,
-                    )
-                if np.random.randint(0, 100) == 0:
-                    img_and_mask = tf.keras.preprocessing.image.random_rotation(
-                        img_and_mask, rg=45,
-                        row_axis=0, col_axis=1, channel_axis=2,
-                        fill_mode='constant', cval=0.0
-                    )
-                if np.random.randint(0, 100) == 0:
-                    img_and_mask[:, :, :channels] = tf.keras.preprocessing.image.random_brightness(
-                        patch_img,
-                        brightness_range=(0.8, 1.1)
-                    )/255
-                if np.random.randint(0, 100) == 0:
-                    img_and_mask = tf.keras.preprocessing.image.random_shear(
-                        img_and_mask, intensity = 45,
-                        row_axis=0, col_axis=1, channel_axis=2,
-                        fill_mode='constant', cval=0.0,
-                    )
-
-                patch_img = img_and_mask[:, :, :channels]
-                patch_lbl = img_and_mask[:, :, channels:]
-                if np.random.randint(0, 100) == 0:
-                    patch_img = add_sp_noise(patch_img)
-            # Can be ignored
-            if np.sum(patch_lbl) == 0 and np.random.randint(0, 100) > 50:    # 50% chance of selecting all negative sample
-                continue
-            # X.append(np.expand_dims(patch_img, axis=-1))
-            # Y.append(np.expand_dims(patch_lbl, axis=-1))
-            X.append(patch_img)
-            Y.append(patch_lbl)
-            # k += 1
-            b += 1
-        if caps:
-            x, y = np.array(X), np.array(Y)
-            yield ([x, y], [y, y*x])
-        else:
-
-            yield np.array(X), np.array(Y)
-
-
-def full_image_generator(dataset_root_dir, image_dir, label_dir, image_ext, batch_size, image_size=(256, 256), caps=False):
+                images, labels = augmentation.augment(images, labels, rng, stats)
+            for i in range(batch_size):
+                X[i] = images[i]
+                Y[i] = labels[i]
+            output = buffers.output()
+        if stats is not None:
+            stats.count('samples', batch_size)
+            stats.count('batches')
+        yield output
+
+
+def data_dataset(dataset_root_dir, image_dir, label_dir, image_ext, batch_size, patch_size=(64, 64), input_channel=1, preprocess=False, data_aug=True, caps=False, store_dir=None,
+                 negative_fraction=None, seed=None, stats=None, num_parallel_calls=tf.data.experimental.AUTOTUNE, prefetch=tf.data.experimental.AUTOTUNE):
+    # tf.data version of data_generator: patches are sampled by parallel map calls and prefetched while the model trains.
+    # Sample i draws from RandomState([seed, i]) whatever thread runs it, so a fixed seed always gives the same batches.
+    # With stats, the batches go through timed_dataset so 'batch' is the wait of the trainer after the prefetch buffer.
+    store = open_store(dataset_root_dir, image_dir, label_dir, image_ext, preprocess=preprocess, store_dir=store_dir)
+    sampler = PatchSampler(store, patch_size, negative_fraction)
+    count_sampler(stats, sampler)
+    channels = store.patch_channels(input_channel)
+    if seed is None:
+        seed = np.random.randint(2**31)
+
+    def sample(i):
+        rng = np.random.RandomState([seed, i])
+        with timer_of(stats)('sample'):
+            patch = random_patch(sampler, channels, data_aug, rng, stats=stats)
+        if stats is not None:
+            stats.count('samples')
+        return np.asarray(patch[0], dtype=np.float32), np.asarray(patch[1], dtype=np.float32)
+
+    def load(i):
+        patch_img, patch_lbl = tf.numpy_function(sample, [i], [tf.float32, tf.float32])
+        patch_img.set_shape((*patch_size, channels))
+        patch_lbl.set_shape((*patch_size, 1))
+        return patch_img, patch_lbl
+
+    dataset = tf.data.Dataset.range(np.iinfo(np.int64).max)
+    dataset = dataset.map(load, num_parallel_calls=num_parallel_calls)
+    dataset = dataset.batch(batch_size)
+    if caps:
+        dataset = dataset.map(lambda x, y: ((x, y), (y, y*x)))
+    options = tf.data.Options()
+    options.experimental_deterministic = True
+    dataset = dataset.with_options(options).prefetch(prefetch)
+    if stats is not None:
+        dataset = timed_dataset(dataset, stats)
+    return dataset
+
+
+def full_image_generator(dataset_root_dir, image_dir, label_dir, image_ext, batch_size, image_size=(256, 256), caps=False, store_dir=None,
+                         augmentation=FULL_IMAGE_AUGMENTATION, cache_margin=None, buffer_slots=BATCH_RING_SLOTS, stats=None):
+    # cache_margin (e.g. FULL_IMAGE_CACHE_MARGIN) keeps the square frames resized once to image_size * (1 + cache_margin)
+    # as uint8, augmentation then runs close to the training resolution instead of the native one
     k = 0
-    files = glob('{}/{}/*.{}'.format(dataset_root_dir, image_dir, image_ext))
+    store = open_store(dataset_root_dir, image_dir, label_dir, image_ext, store_dir=store_dir)
+    if cache_margin is not None:
+        cache_size = (int(round(image_size[0] * (1 + cache_margin))), int(round(image_size[1] * (1 + cache_margin))))
     images = []
     labels = []
-    for file in files:
-        img = np.asarray(Image.open(file))
-        lbl = np.asarray(Image.open(file.replace(image_dir, label_dir)))
-        if len(lbl.shape) == 3:
-            lbl = lbl[:, :, 0]
-        img = square_frame(img)
-        lbl = square_frame(lbl)
-        if np.max(img) > 1:
-            data_img = np.array(img / 255, dtype=np.float32)
-        if np.max(lbl) > 1:
-            data_lbl = np.array(lbl / 255, dtype=np.float32)
-        if len(data_img.shape) == 2:
-            data_img = np.expand_dims(data_img, axis=-1)
-        else:
-            data_img = data_img[:, :, :1]
-        if len(data_lbl.shape) == 2:
-            data_lbl = np.expand_dims(data_lbl, axis=-1)
-        else:
-            data_lbl = data_lbl[:, :, :1]
-        res_img = np.zeros((*image_size, 1))
-        res_lbl = np.zeros((*image_size, 1))
+    for i in range(len(store)):
+        img = square_frame(store.image(i)[:, :, :1])
+        lbl = square_frame(store.label(i))
+        if cache_margin is not None:
+            images.append(resize_frame(img, cache_size))
+            labels.append(resize_frame(lbl, cache_size))
+            continue
+        data_img = np.array(img / 255, dtype=np.float32)
+        data_lbl = np.array(lbl / 255, dtype=np.float32)
 
         images.append(data_img)
         labels.append(data_lbl)
@@ -170,95 +166,45 @@ def full_image_generator(dataset_root_dir, image_dir, label_dir, image_ext, batc
         #     images.append(data_img)
         #     labels.append(data_lbl)
 
+    buffers = BatchRing(batch_size, (*image_size, 1), (*image_size, 1), caps, buffer_slots)
+    timer = timer_of(stats)
+    if stats is not None:
+        stats.count('rejected/negative_patch', 0)
     while True:
-        X = []
-        Y = []
-        b = 0
-        while b < batch_size:
-            index = np.random.randint(len(images))
-            image = images[index]
-            img_shp = image.shape
-            label = labels[index]
-            patch_img = np.copy(image)
-            patch_lbl = np.copy(label)
-            img_and_mask = np.concatenate((patch_img, patch_lbl), axis=2)
-            # Horizontal Flipping
-            if np.random.randint(0, 10) == 0:
-                img_and_mask = img_and_mask[:, ::-1, ...]
-            # Vertical Flipping
-            if np.random.randint(0, 10) == 0:
-                img_and_mask = img_and_mask[::-1, :, ...]
-            # # Patch Stretching
-            # if np.random.randint(0, 100) == 0:
-            #     height_scale = 1 + np.random.rand()
-            #     width_scale = 1 + np.random.rand()
-            #     # Horizontal
-            #     if np.random.choice([True, False]):
-            #         patch_img = cv2.resize(patch_img, (int(patch_size[1] * width_scale), patch_size[0]))
-            #         patch_lbl = cv2.resize(patch_lbl, (int(patch_size[1] * width_scale), patch_size[0]))
-            #     # Vertical
-            #     if np.random.choice([True, False]):
-            #         patch_img = cv2.resize(patch_img, (patch_size[1], int(patch_size[0] * height_scale)))
-            #         patch_lbl = cv2.resize(patch_lbl, (patch_size[1], int(patch_size[0] * height_scale)))
-            #     if len(patch_img.shape) < 3:
-            #         patch_img = np.expand_dims(patch_img, axis=-1)
-            #         patch_lbl = np.expand_dims(patch_lbl, axis=-1)
-            #     img_and_mask[:, :, :1] = patch_img[:patch_size[0], :patch_size[1], ...]
-            #     img_and_mask[:, :, 1:] = patch_lbl[:patch_size[0], :patch_size[1], ...]
-
-            if np.random.randint(0, 10) == 0:
-                img_and_mask = tf.keras.preprocessing.image.random_zoom(
-                    img_and_mask, zoom_range=(0.7, 1.3),
-                    row_axis=0, col_axis=1, channel_axis=2,
-                    fill_mode='constant', cval=0.0
-                )
-            if np.random.randint(0, 100) == 0:
-                img_and_mask = tf.keras.preprocessing.image.random_shift(        # very low prob
-                    img_and_mask, wrg=1.5, hrg=1.5,
-                    row_axis=0, col_axis=1, channel_axis=2,
-                    fill_mode='constant', cval=0.0,
-                )
-            if np.random.randint(0, 10) == 0:
-                img_and_mask = tf.keras.preprocessing.image.random_rotation(
-                    img_and_mask, rg=180,
-                    row_axis=0, col_axis=1, channel_axis=2,
-                    fill_mode='constant', cval=0.0
-                )
-            if np.random.randint(0, 10) == 0:
-                img_and_mask[:, :, :1] = tf.keras.preprocessing.image.random_brightness(
-                    patch_img,
-                    brightness_range=(0.8, 1.1)
-                )/255
-            if np.random.randint(0, 100) == 0:
-                img_and_mask = tf.keras.preprocessing.image.random_shear(
-                    img_and_mask, intensity = 60,
-                    row_axis=0, col_axis=1, channel_axis=2,
-                    fill_mode='constant', cval=0.0,
-                )
-
-            patch_img = img_and_mask[:, :, :1]
-            patch_lbl = img_and_mask[:, :, 1:]
-            if np.random.randint(0, 50) == 0:
-                patch_img = add_sp_noise(patch_img)
-            # Can be ignored
-            if np.sum(patch_lbl) == 0 and np.random.randint(0, 100) > 50:    # 50% chance of selecting all negative sample
-                continue
-            # X.append(np.expand_dims(patch_img, axis=-1))
-            # Y.append(np.expand_dims(patch_lbl, axis=-1))
-            patch_img = np.expand_dims(cv2.resize(patch_img, dsize=(image_size[1], image_size[0])), axis=-1)
-            patch_lbl = np.expand_dims(cv2.resize(patch_lbl, dsize=(image_size[1], image_size[0])), axis=-1)
-            # patch_img = tf.image.resize(patch_img, image_size).numpy()
-            # patch_lbl = tf.image.resize(patch_lbl, image_size).numpy()
-            X.append(patch_img)
-            Y.append(patch_lbl)
-            # k += 1
-            b += 1
-        if caps:
-            x, y = np.array(X), np.array(Y)
-            yield ([x, y], [y, y*x])
-        else:
+        with timer('batch'):
+            X, Y = buffers.next_slot()
+            b = 0
+            while b < batch_size:
+                indices = np.random.randint(len(images), size=batch_size - b)
+                batch_img = [images[i] for i in indices]
+                batch_lbl = [labels[i] for i in indices]
+                if cache_margin is not None:
+                    batch_img = [img / np.float32(255) for img in batch_img]
+                    batch_lbl = [lbl / np.float32(255) for lbl in batch_lbl]
+                batch_img, batch_lbl = augmentation.augment(batch_img, batch_lbl, stats=stats)
+                for patch_img, patch_lbl in zip(batch_img, batch_lbl):
+                    if not keep_sample(patch_lbl):
+                        if stats is not None:
+                            stats.count('rejected/negative_patch')
+                        continue
+                    with timer('resize'):
+                        X[b, :, :, 0] = cv2.resize(patch_img, dsize=(image_size[1], image_size[0]))
+                        Y[b, :, :, 0] = cv2.resize(patch_lbl, dsize=(image_size[1], image_size[0]))
+                    # patch_img = tf.image.resize(patch_img, image_size).numpy()
+                    # patch_lbl = tf.image.resize(patch_lbl, image_size).numpy()
+                    b += 1
+            output = buffers.output()
+        if stats is not None:
+            stats.count('samples', batch_size)
+            stats.count('batches')
+        yield output
+
+
+def resize_frame(img, size):
+    # uint8 (height, width, 1) copy of a square frame resized to size (height, width)
+    resized = cv2.resize(np.asarray(img, dtype=np.uint8), dsize=(size[1], size[0]), interpolation=cv2.INTER_AREA)
+    return resized.reshape(size[0], size[1], -1)
 
-            yield np.array(X), np.array(Y)
 
 def square_frame(img):
     h, w = img.shape[:2]
@@ -278,28 +224,12 @@ def square_frame(img):
 
 
 def main():
-    current_batch = 0
-    total_batches = 10
-    batch_size = 32
+    total_patches = 320
     patch_size = (256, 256)
-    pbar = tqdm(total=total_batches * batch_size, desc='Progress')
-    i = 0
-    RESULT_DIR = 'testing_dataset/patches'
-    if not os.path.isdir(RESULT_DIR):
-        os.mkdir(RESULT_DIR)
-    for data in data_generator('testing_dataset', 'input', 'label-1', 'png', batch_size, patch_size, preprocess=True, data_aug=True):
-        i = current_batch * batch_size
-        for X, Y in zip(data[0], data[1]):
-            if X.shape[2] == 1:
-                X = X[:, :, 0]
-            Image.fromarray(np.array(X * 255, dtype=np.uint8)).save(RESULT_DIR + '/{:08d}_1.png'.format(i))
-            Image.fromarray(np.array(Y[:, :, 0] * 255, dtype=np.uint8)).save(RESULT_DIR + '/{:08d}_2.png'.format(i))
-            i += 1
-            pbar.update()
-        current_batch += 1
-        if current_batch >= total_batches:
-            break
-    pbar.close()
+    # validation patches, packed in uint8 shards and reused while the parameters stay the same
+    bank = build_patch_bank('testing_dataset', 'input', 'label-1', 'png', 'testing_dataset/patch_bank', total_patches, patch_size,
+                            preprocess=True, data_aug=True, augmentation=PATCH_AUGMENTATION)
+    print("{} patches in {}".format(len(bank), bank.bank_dir))
 
 
 if __name__ == '__main__':
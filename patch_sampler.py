@@ -0,0 +1,190 @@
+import numpy as np
+import cv2
+from collections import deque
+
+
+NEGATIVE_KEEP = 0.51        # chance data_generator used to keep an all-negative patch (randint(0, 100) <= 50)
+
+
+
+def crop_patch(store, position, patch_size, channels):
+    # float32 (patch_img, patch_lbl) in [0, 1] of a sampled (index, top, left) position, also used by the workers of
+    # parallel_generator that have the store but no sampler
+    index, top, left = position
+    ph, pw = patch_size
+    patch_img = np.array(store.image(index)[top:top+ph, left:left+pw, :channels], dtype=np.float32) / 255
+    patch_lbl = np.array(store.label(index)[top:top+ph, left:left+pw, ...], dtype=np.float32) / 255
+    return patch_img, patch_lbl
+
+class PatchSampler(object):
+    # Draws patch positions of a DatasetStore with the positive / negative mix decided up front.
+    # For every image the summed-area table of the label mask gives the vessel pixel count of each valid top-left
+    # corner in O(1); positions are split into negative (no vessel) and positive ones. A sample picks an image
+    # uniformly (as data_generator did, whatever its size), then the class with the negative fraction of that image,
+    # then a position uniformly among the positions of that class in the image. Images smaller than the patch never
+    # come up.
+    def __init__(self, store, patch_size, negative_fraction=None):
+        self.store = store
+        self.patch_size = patch_size
+        self.indices = []       # store index of every image with at least one valid position
+        self.excluded = []      # store index of the images smaller than the patch
+        self.negative = []      # (H - ph, W - pw) bool, True where the patch has no vessel pixel
+        self.row_counts = {True: [], False: []}     # cumulative number of positions per row, for each class
+        for index in range(len(store)):
+            negative = self.negative_positions(store.label(index), patch_size)
+            if negative is None:
+                self.excluded.append(index)
+                continue
+            self.indices.append(index)
+            self.negative.append(negative)
+            for cls in (True, False):
+                self.row_counts[cls].append(np.cumsum(np.count_nonzero(negative == cls, axis=1)))
+        if not self.indices:
+            raise ValueError("No image larger than the patch size {}".format(patch_size))
+        # number of positions per image, for each class
+        self.class_counts = {cls: np.array([counts[-1] for counts in self.row_counts[cls]], dtype=np.int64)
+                             for cls in (True, False)}
+        n_negative, n_positive = self.class_counts[True], self.class_counts[False]
+        if negative_fraction is None:
+            # data_generator's mix inside each image: a uniform position, kept with NEGATIVE_KEEP chance when negative
+            fractions = NEGATIVE_KEEP * n_negative / (n_positive + NEGATIVE_KEEP * n_negative)
+        else:
+            fractions = np.full(len(self.indices), float(negative_fraction))
+        fractions[n_negative == 0] = 0.
+        fractions[n_positive == 0] = 1.
+        self.fractions = fractions      # negative fraction of each image
+        self.negative_fraction = float(fractions.mean())      # overall share of negative patches
+
+    @staticmethod
+    def negative_positions(label, patch_size):
+        # bool map over the top-left corners data_generator could draw (randint(H - ph), randint(W - pw))
+        height, width = label.shape[:2]
+        n_h, n_w = height - patch_size[0], width - patch_size[1]
+        if n_h <= 0 or n_w <= 0:
+            return None
+        table = cv2.integral(np.ascontiguousarray(label[:, :, 0] > 0, dtype=np.uint8))
+        ph, pw = patch_size
+        counts = table[ph:ph+n_h, pw:pw+n_w] - table[:n_h, pw:pw+n_w] - table[ph:ph+n_h, :n_w] + table[:n_h, :n_w]
+        return counts == 0
+
+    def _position(self, i, cls, k):
+        # k-th position of class cls in image i -> (store index, top, left)
+        row_counts = self.row_counts[cls][i]
+        top = np.searchsorted(row_counts, k, side='right')
+        k -= row_counts[top - 1] if top else 0
+        left = np.flatnonzero(self.negative[i][top] == cls)[k]
+        return self.indices[i], int(top), int(left)
+
+    def sample(self, n, rng=np.random):
+        # n (store index, top, left) positions
+        images = rng.randint(len(self.indices), size=n)
+        negatives = rng.rand(n) < self.fractions[images]
+        positions = []
+        for i, cls in zip(images, negatives):
+            cls = bool(cls)
+            positions.append(self._position(i, cls, rng.randint(self.class_counts[cls][i])))
+        return positions
+
+    def crop(self, position, channels):
+        # float32 (patch_img, patch_lbl) in [0, 1]
+        return crop_patch(self.store, position, self.patch_size, channels)
+
+
+class HardExampleSampler(PatchSampler):
+    # PatchSampler that oversamples the regions where the model does badly. The valid top-left corners of every
+    # image are split in a coarse grid of cell x cell cells, each with a priority (1 at start) multiplying its base
+    # weight (the chance PatchSampler lands in the cell: 1 / images times the class shares of its positions).
+    # Losses fed back through update() move the priority of the cells of the sampled patches towards
+    # loss / running mean loss, with an exponential decay, and never below floor so every region keeps being visited.
+    # Every sample() call is remembered in a FIFO, update_next() gives the loss of the oldest pending batch.
+    def __init__(self, store, patch_size, negative_fraction=None, cell=64, decay=0.9, floor=0.2):
+        super(HardExampleSampler, self).__init__(store, patch_size, negative_fraction)
+        self.cell = cell
+        self.decay = decay
+        self.floor = floor
+        self.grids = []         # (cells_h, cells_w) shape per image
+        self.offsets = [0]      # first cell of every image in the flat arrays
+        weights = []
+        negatives = []
+        for i, negative in enumerate(self.negative):
+            starts_h = np.arange(0, negative.shape[0], cell)
+            starts_w = np.arange(0, negative.shape[1], cell)
+            n_neg = np.add.reduceat(np.add.reduceat(negative, starts_h, axis=0, dtype=np.int64), starts_w, axis=1)
+            n_all = np.add.reduceat(np.add.reduceat(np.ones(negative.shape, dtype=np.int64), starts_h, axis=0), starts_w, axis=1)
+            self.grids.append(n_neg.shape)
+            self.offsets.append(self.offsets[-1] + n_neg.size)
+            fraction = self.fractions[i]
+            negative_weight = fraction * n_neg / max(self.class_counts[True][i], 1)
+            positive_weight = (1 - fraction) * (n_all - n_neg) / max(self.class_counts[False][i], 1)
+            weights.append((negative_weight + positive_weight) / len(self.negative))
+            negatives.append(negative_weight / len(self.negative))
+        self.weights = np.concatenate([w.ravel() for w in weights]).astype(np.float64)
+        self.negative_share = np.concatenate([n.ravel() for n in negatives]) / np.maximum(self.weights, 1e-12)
+        self.priority = np.ones_like(self.weights)
+        self.image_of = {index: i for i, index in enumerate(self.indices)}     # store index -> image in self.negative
+        self.mean_loss = None
+        self.pending = deque()
+
+    def cell_of(self, position):
+        # flat cell number of a (store index, top, left) position
+        index, top, left = position
+        i = self.image_of[index]
+        return self.offsets[i] + (top // self.cell) * self.grids[i][1] + left // self.cell
+
+    def sample(self, n, rng=np.random):
+        p = np.cumsum(self.weights * self.priority)
+        cells = np.searchsorted(p, rng.rand(n) * p[-1], side='right')
+        positions = []
+        for c in np.minimum(cells, len(p) - 1):
+            i = np.searchsorted(self.offsets, c, side='right') - 1
+            cy, cx = divmod(c - self.offsets[i], self.grids[i][1])
+            block = self.negative[i][cy*self.cell:(cy+1)*self.cell, cx*self.cell:(cx+1)*self.cell]
+            cls = bool(rng.rand() < self.negative_share[c])
+            candidates = np.flatnonzero(block == cls)
+            if len(candidates) == 0:
+                candidates = np.flatnonzero(block == (not cls))
+            top, left = divmod(candidates[rng.randint(len(candidates))], block.shape[1])
+            positions.append((self.indices[i], int(cy*self.cell + top), int(cx*self.cell + left)))
+        self.pending.append(positions)
+        return positions
+
+    def update(self, positions, losses):
+        # losses: one value per position, or a single value for all of them (batch mean loss)
+        losses = np.broadcast_to(np.asarray(losses, dtype=np.float64), (len(positions),))
+        if not np.all(np.isfinite(losses)):
+            return
+        batch_mean = losses.mean()
+        self.mean_loss = batch_mean if self.mean_loss is None else self.decay * self.mean_loss + (1 - self.decay) * batch_mean
+        if self.mean_loss <= 0:
+            return
+        for position, loss in zip(positions, losses):
+            c = self.cell_of(position)
+            self.priority[c] = max(self.floor, self.decay * self.priority[c] + (1 - self.decay) * loss / self.mean_loss)
+
+    def update_next(self, loss):
+        # loss of the oldest batch handed out and not yet reported, batches are trained in the order they were sampled
+        if self.pending:
+            self.update(self.pending.popleft(), loss)
+
+
+def hard_example_callback(sampler, running_mean=True):
+    # Keras callback feeding the training loss of every batch back to a HardExampleSampler. With running_mean the
+    # 'loss' of the batch logs is the mean since the start of the epoch (tf.keras 2.2+) and the batch loss is
+    # recovered from two consecutive values.
+    import tensorflow as tf
+    state = {'batches': 0, 'mean': 0.}
+
+    def on_epoch_begin(epoch, logs=None):
+        state['batches'], state['mean'] = 0, 0.
+
+    def on_train_batch_end(batch, logs=None):
+        if not logs or 'loss' not in logs:
+            return
+        loss = float(logs['loss'])
+        if running_mean:
+            state['batches'] += 1
+            k = state['batches']
+            loss, state['mean'] = k * loss - (k - 1) * state['mean'], loss
+        sampler.update_next(loss)
+
+    return tf.keras.callbacks.LambdaCallback(on_epoch_begin=on_epoch_begin, on_train_batch_end=on_train_batch_end)
@@ -0,0 +1,147 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+
+class PipelineStats(object):
+    # Opt-in counters of the input pipeline: samples / batches produced, rejected samples by cause, time per named
+    # stage (crop, augmentation branches), queue depth seen by the consumer and the time the generator spends
+    # producing batches versus waiting for the trainer to ask for the next one. Updates may come from several
+    # threads (tf.data map calls), they are serialised by a lock.
+    #
+    # What each pipeline of patch_generator records:
+    # - 'batch' timer (busy_fraction): time the trainer waits for the next batch, in every mode. data_generator
+    #   builds the batch in that time, the worker mode waits for its ring slot, data_dataset times the batches
+    #   leaving the prefetch buffer.
+    # - 'crop' and augmentation timers: summed over the samples, so over the threads or processes producing them
+    #   (worker and tf.data modes may add up to more than the wall time). data_dataset also has 'sample', the
+    #   total time of the parallel map calls.
+    # - 'queue_depth' gauge: worker mode only (batches ready when the trainer asks), the tf.data prefetch buffer
+    #   is not visible from python.
+    # - 'resize' timer: full_image_generator only.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start = time.perf_counter()
+            self.counters = defaultdict(int)
+            self.timers = defaultdict(float)
+            self.gauges = defaultdict(list)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.timers[name] += seconds
+
+    def merge_times(self, timers):
+        # timers measured elsewhere (worker processes)
+        with self.lock:
+            for name, seconds in timers.items():
+                self.timers[name] += seconds
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name].append(value)
+
+    def summary(self):
+        with self.lock:
+            elapsed = time.perf_counter() - self.start
+            counters = defaultdict(int, self.counters)
+            timers = defaultdict(float, self.timers)
+            gauges = {name: list(values) for name, values in self.gauges.items()}
+        samples = counters['samples']
+        rejected = {name.split('/', 1)[1]: n for name, n in counters.items() if name.startswith('rejected/')}
+        drawn = samples + sum(rejected.values())
+        return {
+            'elapsed_s': elapsed,
+            'samples': samples,
+            'batches': counters['batches'],
+            'samples_per_s': samples / elapsed if elapsed else 0.,
+            'batches_per_s': counters['batches'] / elapsed if elapsed else 0.,
+            'rejected': rejected,
+            'rejected_rate': {cause: n / drawn for cause, n in rejected.items()} if drawn else {},
+            'counters': dict(counters),
+            'time_s': dict(timers),
+            'time_per_sample_ms': {name: 1000 * t / samples for name, t in timers.items()} if samples else {},
+            # share of the wall time the trainer spends waiting for batches, close to 1 means it waits on the input
+            'busy_fraction': timers['batch'] / elapsed if elapsed else 0.,
+            'gauges': {name: {'mean': sum(values) / len(values), 'max': max(values), 'last': values[-1]}
+                       for name, values in gauges.items() if values},
+        }
+
+    def save_json(self, path):
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=1, sort_keys=True)
+
+    def scalars(self):
+        # flat {tag: value} of the summary for TensorBoard
+        summary = self.summary()
+        scalars = {'input/samples_per_s': summary['samples_per_s'],
+                   'input/batches_per_s': summary['batches_per_s'],
+                   'input/busy_fraction': summary['busy_fraction']}
+        for cause, rate in summary['rejected_rate'].items():
+            scalars['input/rejected_rate/' + cause] = rate
+        for name, ms in summary['time_per_sample_ms'].items():
+            scalars['input/time_per_sample_ms/' + name] = ms
+        for name, values in summary['gauges'].items():
+            scalars['input/{}_mean'.format(name)] = values['mean']
+            scalars['input/{}_max'.format(name)] = values['max']
+        return scalars
+
+
+def timer_of(stats):
+    # stats.timer, or a no-op timer when the instrumentation is off
+    if stats is None:
+        return lambda name: nullcontext()
+    return stats.timer
+
+
+def timed_dataset(dataset, stats):
+    # dataset yielding the batches of dataset, with the time the trainer waits for each of them in the 'batch' timer
+    # (the wait is measured on the consumer side, after the prefetch buffer of dataset)
+    import tensorflow as tf
+
+    def timed():
+        iterator = iter(dataset)
+        while True:
+            with stats.timer('batch'):
+                batch = next(iterator)
+            stats.count('batches')
+            yield batch
+
+    return tf.data.Dataset.from_generator(timed, output_signature=dataset.element_spec)
+
+
+def stats_callback(stats, log_dir, json_path=None):
+    # Keras callback writing the pipeline stats of every epoch to TensorBoard (log_dir/input) and to json_path,
+    # the counters restart at the beginning of each epoch
+    import tensorflow as tf
+    writer = tf.summary.create_file_writer(os.path.join(log_dir, 'input'))
+
+    def on_epoch_end(epoch, logs=None):
+        with writer.as_default():
+            for tag, value in stats.scalars().items():
+                tf.summary.scalar(tag, value, step=epoch)
+        writer.flush()
+        if json_path is not None:
+            stats.save_json(json_path)
+
+    return tf.keras.callbacks.LambdaCallback(on_epoch_begin=lambda epoch, logs=None: stats.reset(), on_epoch_end=on_epoch_end)
@@ -1,10 +1,18 @@
 import cv2
 import numpy as np
+import os
+import json
+import hashlib
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 from PIL import Image
 from tqdm import tqdm
 
 
+MANIFEST_NAME = 'manifest.json'    # input hashes + params of the preprocessed images in the result dir
+
+
 def rgb2gray(rgb):
     assert (len(rgb.shape)==4)  #4D arrays
     assert (rgb.shape[3]==3)
@@ -14,22 +22,22 @@ def rgb2gray(rgb):
 
 
 def dataset_normalized(imgs):
+    # Global standardisation followed by a min-max rescale of each image to [0, 255]: the rescale cancels the
+    # dataset mean / std, so each image is only rescaled, in float32, without a float64 copy of the stack
     assert (len(imgs.shape)==4)  #4D arrays
     assert (imgs.shape[1]==1)  #check the channel is 1
-    imgs_normalized = np.empty(imgs.shape)
-    imgs_std = np.std(imgs)
-    imgs_mean = np.mean(imgs)
-    imgs_normalized = (imgs-imgs_mean)/imgs_std
+    imgs_normalized = np.empty(imgs.shape, dtype=np.float32)
     for i in range(imgs.shape[0]):
-        imgs_normalized[i] = ((imgs_normalized[i] - np.min(imgs_normalized[i])) / (np.max(imgs_normalized[i])-np.min(imgs_normalized[i])))*255
+        img_min = np.min(imgs[i])
+        np.subtract(imgs[i], img_min, out=imgs_normalized[i], casting='unsafe')
+        imgs_normalized[i] *= np.float32(255. / (np.max(imgs[i]) - img_min))
     return imgs_normalized
 
 
 def clahe_equalized(imgs):
     assert (len(imgs.shape)==4)  #4D arrays
     assert (imgs.shape[1]==1)  #check the channel is 1
-    #create a CLAHE object (Arguments are optional).
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+    clahe = get_clahe()
     imgs_equalized = np.empty(imgs.shape)
     for i in range(imgs.shape[0]):
         imgs_equalized[i,0] = clahe.apply(np.array(imgs[i,0], dtype = np.uint8))
@@ -39,10 +47,7 @@ def clahe_equalized(imgs):
 def adjust_gamma(imgs, gamma=1.0):
     assert (len(imgs.shape)==4)  #4D arrays
     assert (imgs.shape[1]==1)  #check the channel is 1
-    # build a lookup table mapping the pixel values [0, 255] to
-    # their adjusted gamma values
-    invGamma = 1.0 / gamma
-    table = np.array([((i / 255.0) ** invGamma) * 255 for i in np.arange(0, 256)]).astype("uint8")
+    table = gamma_table(gamma)
     # apply gamma correction using the lookup table
     new_imgs = np.empty(imgs.shape)
     for i in range(imgs.shape[0]):
@@ -50,6 +55,73 @@ def adjust_gamma(imgs, gamma=1.0):
     return new_imgs
 
 
+@lru_cache(maxsize=None)
+def get_clahe(clip_limit=2.0, tile_grid_size=(8, 8)):
+    #create a CLAHE object once and share it between calls
+    return cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid_size)
+
+
+@lru_cache(maxsize=None)
+def gamma_table(gamma=1.0):
+    # lookup table mapping the pixel values [0, 255] to their adjusted gamma values
+    table = (((np.arange(256) / 255.0) ** (1.0 / gamma)) * 255).astype(np.uint8)
+    table.flags.writeable = False
+    return table
+
+
+@lru_cache(maxsize=None)
+def gamma_tables(gammas):
+    # (256, 1, len(gammas)) lookup table applying every gamma of the tuple in a single cv2.LUT pass
+    tables = np.stack([gamma_table(g) for g in gammas], axis=-1).reshape(256, 1, len(gammas))
+    tables.flags.writeable = False
+    return tables
+
+
+def get_gammas(gamma=1.2, gamma_offset=0.4, multi_gamma_channel=False):
+    if multi_gamma_channel:
+        return (gamma-gamma_offset, gamma, gamma+gamma_offset)
+    return (gamma,)
+
+
+def multi_gamma(clache, gammas, out=None):
+    # (H, W) uint8 CLAHE output -> (H, W, len(gammas)) uint8 gamma corrected channels, all from one LUT pass
+    tables = gamma_tables(tuple(gammas))
+    if out is None:
+        out = np.empty((*clache.shape, len(gammas)), dtype=np.uint8)
+    if len(gammas) == 1:
+        cv2.LUT(clache, tables[:, 0, 0], dst=out[:, :, 0])
+    else:
+        cv2.LUT(cv2.merge([clache]*len(gammas)), tables, dst=out)
+    return out
+
+
+def pre_process_images(images, gamma=1.2, gamma_offset=0.4, multi_gamma_channel=False, as_float=False,
+                       clip_limit=2.0, tile_grid_size=(8, 8)):
+    # Batched pre_process_image for a (N, H, W, 3) stack, returns the (N, H, W, C) channel last images as uint8
+    # (or float32 in 0-1 range with as_float). Only per image uint8/float32 scratch buffers are allocated.
+    images = np.asarray(images)
+    assert (len(images.shape)==4)  #4D arrays
+    assert (images.shape[3]>=3)
+    n, h, w = images.shape[:3]
+    gammas = get_gammas(gamma, gamma_offset, multi_gamma_channel)
+    clahe = get_clahe(clip_limit, tuple(tile_grid_size))
+    weights = np.array([[0.299, 0.587, 0.114]], dtype=np.float32)
+    rgb = np.empty((h, w, 3), dtype=np.float32)
+    gray = np.empty((h, w), dtype=np.float32)
+    gray_u8 = np.empty((h, w), dtype=np.uint8)
+    out = np.empty((n, h, w, len(gammas)), dtype=np.uint8)
+    for i in range(n):
+        np.copyto(rgb, images[i, :, :, :3], casting='unsafe')
+        cv2.transform(rgb, weights, dst=gray)
+        cv2.normalize(gray, gray, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX)
+        gray *= 255
+        np.copyto(gray_u8, gray, casting='unsafe')   # truncates like np.array(..., dtype=np.uint8)
+        multi_gamma(clahe.apply(gray_u8), gammas, out=out[i])
+    if as_float:
+        return out.astype(np.float32) / 255.
+    return out
+
+
 def read_training_images(files):
     images = []
     for i in tqdm(range(len(files)), desc="Reading Images"):
@@ -60,18 +132,14 @@ def read_training_images(files):
 
 
 def pre_process_image(image, return_channel_last_img=False, gamma=1.2, gamma_offset=0.4, multi_gamma_channel=False):
+    # gray -> normalize -> CLAHE once, then every gamma channel from the same CLAHE output in one LUT pass
     gray_scale = rgb2gray(np.expand_dims(image, axis=0))[0]
     normalized = cv2.normalize(gray_scale, None, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F) * 255
-    normalized = np.einsum('kijl->klij', np.reshape(normalized, (1, *normalized.shape, 1)))
-    clache = clahe_equalized(normalized)
-    gamma_corrected = adjust_gamma(clache, gamma)
-    if multi_gamma_channel:
-        gamma_corrected1 = adjust_gamma(clache, gamma-gamma_offset)
-        gamma_corrected3 = adjust_gamma(clache, gamma+gamma_offset)
-        gamma_corrected = np.concatenate([gamma_corrected1, gamma_corrected, gamma_corrected3], axis=1)
+    clache = get_clahe().apply(np.array(normalized, dtype=np.uint8))
+    gamma_corrected = multi_gamma(clache, get_gammas(gamma, gamma_offset, multi_gamma_channel))
     if return_channel_last_img:
-        return np.einsum('klij->kijl', gamma_corrected)[0]
-    return gamma_corrected/255.
+        return gamma_corrected.astype(np.float64)
+    return np.expand_dims(gamma_corrected.transpose(2, 0, 1), axis=0)/255.
 
 
 def paint_border_overlap(full_imgs, patch_h, patch_w, stride_h, stride_w, verbose=True):
@@ -79,26 +147,21 @@ def paint_border_overlap(full_imgs, patch_h, patch_w, stride_h, stride_w, verbos
     assert (full_imgs.shape[1]==1 or full_imgs.shape[1]==3)  #check the channel is 1 or 3
     img_h = full_imgs.shape[2]  #height of the full image
     img_w = full_imgs.shape[3] #width of the full image
-    leftover_h = (img_h-patch_h)%stride_h  #leftover on the h dim
-    leftover_w = (img_w-patch_w)%stride_w  #leftover on the w dim
-    if (leftover_h != 0):  #change dimension of img_h
-        if verbose:
+    plan = get_tiling_plan(img_h, img_w, patch_h, patch_w, stride_h, stride_w)
+    if verbose:
+        leftover_h = (img_h-patch_h)%stride_h  #leftover on the h dim
+        leftover_w = (img_w-patch_w)%stride_w  #leftover on the w dim
+        if (leftover_h != 0):
             print ("\nthe side H is not compatible with the selected stride of " +str(stride_h))
             print ("img_h " +str(img_h) + ", patch_h " +str(patch_h) + ", stride_h " +str(stride_h))
             print ("(img_h - patch_h) MOD stride_h: " +str(leftover_h))
             print ("So the H dim will be padded with additional " +str(stride_h - leftover_h) + " pixels")
-        tmp_full_imgs = np.zeros((full_imgs.shape[0],full_imgs.shape[1],img_h+(stride_h-leftover_h),img_w))
-        tmp_full_imgs[0:full_imgs.shape[0],0:full_imgs.shape[1],0:img_h,0:img_w] = full_imgs
-        full_imgs = tmp_full_imgs
-    if (leftover_w != 0):   #change dimension of img_w
-        if verbose:
+        if (leftover_w != 0):
             print ("the side W is not compatible with the selected stride of " +str(stride_w))
             print ("img_w " +str(img_w) + ", patch_w " +str(patch_w) + ", stride_w " +str(stride_w))
             print ("(img_w - patch_w) MOD stride_w: " +str(leftover_w))
             print ("So the W dim will be padded with additional " +str(stride_w - leftover_w) + " pixels")
-        tmp_full_imgs = np.zeros((full_imgs.shape[0],full_imgs.shape[1],full_imgs.shape[2],img_w+(stride_w - leftover_w)))
-        tmp_full_imgs[0:full_imgs.shape[0],0:full_imgs.shape[1],0:full_imgs.shape[2],0:img_w] = full_imgs
-        full_imgs = tmp_full_imgs
+    full_imgs = plan.pad(full_imgs)
     if verbose:
         print ("new full images shape: \n" +str(full_imgs.shape))
     return full_imgs
@@ -108,56 +171,63 @@ def paint_border_overlap(full_imgs, patch_h, patch_w, stride_h, stride_w, verbos
 def extract_ordered_overlap(full_imgs, patch_h, patch_w,stride_h,stride_w, verbose=True):
     assert (len(full_imgs.shape)==4)  #4D arrays
     assert (full_imgs.shape[1]==1 or full_imgs.shape[1]==3)  #check the channel is 1 or 3
-    img_h = full_imgs.shape[2]  #height of the full image
-    img_w = full_imgs.shape[3] #width of the full image
-    assert ((img_h-patch_h)%stride_h==0 and (img_w-patch_w)%stride_w==0)
-    N_patches_img = ((img_h-patch_h)//stride_h+1)*((img_w-patch_w)//stride_w+1)  #// --> division between integers
-    N_patches_tot = N_patches_img*full_imgs.shape[0]
+    plan = get_tiling_plan(full_imgs.shape[2], full_imgs.shape[3], patch_h, patch_w, stride_h, stride_w)
+    assert (plan.is_padded)
     if verbose:
-        print ("Number of patches on h : " +str(((img_h-patch_h)//stride_h+1)))
-        print ("Number of patches on w : " +str(((img_w-patch_w)//stride_w+1)))
-        print ("number of patches per image: " +str(N_patches_img) +", totally for this dataset: " +str(N_patches_tot))
-    patches = np.empty((N_patches_tot,full_imgs.shape[1],patch_h,patch_w))
-    iter_tot = 0   #iter over the total number of patches (N_patches)
-    for i in range(full_imgs.shape[0]):  #loop over the full images
-        for h in range((img_h-patch_h)//stride_h+1):
-            for w in range((img_w-patch_w)//stride_w+1):
-                patch = full_imgs[i,:,h*stride_h:(h*stride_h)+patch_h,w*stride_w:(w*stride_w)+patch_w]
-                patches[iter_tot]=patch
-                iter_tot +=1   #total
-    assert (iter_tot==N_patches_tot)
-    return patches  #array with all the full_imgs divided in patches
-
-
-def recompone_overlap(preds, img_h, img_w, stride_h, stride_w, verbose=True):
-    assert (len(preds.shape)==4)  #4D arrays
-    assert (preds.shape[1]==1 or preds.shape[1]==3)  #check the channel is 1 or 3
-    patch_h = preds.shape[2]
-    patch_w = preds.shape[3]
+        print ("Number of patches on h : " +str(plan.N_patches_h))
+        print ("Number of patches on w : " +str(plan.N_patches_w))
+        print ("number of patches per image: " +str(plan.N_patches_img) +", totally for this dataset: " +str(plan.N_patches_img*full_imgs.shape[0]))
+    return plan.extract(full_imgs)  #array with all the full_imgs divided in patches
+
+
+def view_ordered_overlap(full_imgs, patch_h, patch_w, stride_h, stride_w):
+    # Read-only (N, N_patches_h, N_patches_w, C, patch_h, patch_w) sliding window view of full_imgs,
+    # same patch order as extract_ordered_overlap but nothing is copied
+    assert (len(full_imgs.shape)==4)  #4D arrays
+    img_h = full_imgs.shape[2]
+    img_w = full_imgs.shape[3]
+    assert ((img_h-patch_h)%stride_h==0 and (img_w-patch_w)%stride_w==0)
     N_patches_h = (img_h-patch_h)//stride_h+1
     N_patches_w = (img_w-patch_w)//stride_w+1
-    N_patches_img = N_patches_h * N_patches_w
+    s_n, s_c, s_h, s_w = full_imgs.strides
+    return np.lib.stride_tricks.as_strided(
+        full_imgs,
+        shape=(full_imgs.shape[0], N_patches_h, N_patches_w, full_imgs.shape[1], patch_h, patch_w),
+        strides=(s_n, s_h*stride_h, s_w*stride_w, s_c, s_h, s_w),
+        writeable=False)
+
+
+def iter_ordered_overlap(full_imgs, patch_h, patch_w, stride_h, stride_w, batch_size=16, channel_last=False, dtype=np.float32):
+    # Lazily yields the patches of extract_ordered_overlap in batches, only one batch is materialised at a time.
+    # With channel_last the batches are (B, patch_h, patch_w, C) and can go straight into model.predict
+    windows = view_ordered_overlap(full_imgs, patch_h, patch_w, stride_h, stride_w)
+    N_imgs, N_patches_h, N_patches_w = windows.shape[:3]
+    N_patches_img = N_patches_h*N_patches_w
+    N_patches_tot = N_imgs*N_patches_img
+    if channel_last:
+        windows = windows.transpose(0, 1, 2, 4, 5, 3)
+    for start in range(0, N_patches_tot, batch_size):
+        stop = min(start+batch_size, N_patches_tot)
+        batch = np.empty((stop-start, *windows.shape[3:]), dtype=dtype)
+        for k in range(start, stop):
+            i, k_img = divmod(k, N_patches_img)
+            h, w = divmod(k_img, N_patches_w)
+            batch[k-start] = windows[i, h, w]
+        yield batch
+
+
+def recompone_overlap(preds, img_h, img_w, stride_h, stride_w, verbose=True, blending='uniform'):
+    assert (len(preds.shape)==4)  #4D arrays
+    assert (preds.shape[1]==1 or preds.shape[1]==3)  #check the channel is 1 or 3
+    plan = get_tiling_plan(img_h, img_w, preds.shape[2], preds.shape[3], stride_h, stride_w)
     if verbose:
-        print ("N_patches_h: " +str(N_patches_h))
-        print ("N_patches_w: " +str(N_patches_w))
-        print ("N_patches_img: " +str(N_patches_img))
-    assert (preds.shape[0]%N_patches_img==0)
-    N_full_imgs = preds.shape[0]//N_patches_img
+        print ("N_patches_h: " +str(plan.N_patches_h))
+        print ("N_patches_w: " +str(plan.N_patches_w))
+        print ("N_patches_img: " +str(plan.N_patches_img))
+    assert (preds.shape[0]%plan.N_patches_img==0)
     if verbose:
-        print ("According to the dimension inserted, there are " +str(N_full_imgs) +" full images (of " +str(img_h)+"x" +str(img_w) +" each)")
-    full_prob = np.zeros((N_full_imgs,preds.shape[1],img_h,img_w))  #itialize to zero mega array with sum of Probabilities
-    full_sum = np.zeros((N_full_imgs,preds.shape[1],img_h,img_w))
-
-    k = 0 #iterator over all the patches
-    for i in range(N_full_imgs):
-        for h in range((img_h-patch_h)//stride_h+1):
-            for w in range((img_w-patch_w)//stride_w+1):
-                full_prob[i,:,h*stride_h:(h*stride_h)+patch_h,w*stride_w:(w*stride_w)+patch_w]+=preds[k]
-                full_sum[i,:,h*stride_h:(h*stride_h)+patch_h,w*stride_w:(w*stride_w)+patch_w]+=1
-                k+=1
-    assert(k==preds.shape[0])
-    assert(np.min(full_sum)>=1.0)  #at least one
-    final_avg = full_prob/full_sum
+        print ("According to the dimension inserted, there are " +str(preds.shape[0]//plan.N_patches_img) +" full images (of " +str(img_h)+"x" +str(img_w) +" each)")
+    final_avg = plan.recompone(preds, blending)
     if verbose:
         print (final_avg.shape)
     assert(np.max(final_avg)<=1.0) #max value for a pixel is 1.0
@@ -165,21 +235,278 @@ def recompone_overlap(preds, img_h, img_w, stride_h, stride_w, verbose=True):
     return final_avg
 
 
+def predict_overlap(predict_fn, full_imgs, patch_h, patch_w, stride_h, stride_w, batch_size=16, blending='uniform'):
+    # Streaming version of extract_ordered_overlap -> predict -> recompone_overlap on the padded (N, C, H, W) images.
+    # Patches are generated lazily, predict_fn gets one channel last (B, patch_h, patch_w, C) batch at a time and
+    # its (B, patch_h, patch_w, C') predictions are folded into the output before the next batch is built, so the
+    # memory scales with batch_size instead of the number of patches. Returns the (N, C', H, W) averaged predictions.
+    assert (len(full_imgs.shape)==4)  #4D arrays
+    plan = get_tiling_plan(full_imgs.shape[2], full_imgs.shape[3], patch_h, patch_w, stride_h, stride_w)
+    assert (plan.is_padded)
+    return plan.predict_streaming(predict_fn, full_imgs, batch_size, blending)
+
+
+def accumulate_overlap(full_prob, preds, stride_h, stride_w):
+    # Adds (N, N_patches_h, N_patches_w, C, patch_h, patch_w) patch predictions into full_prob (N, C, H, W) in place
+    N_imgs, N_patches_h, N_patches_w, C, patch_h, patch_w = preds.shape
+    if patch_h%stride_h==0 and patch_w%stride_w==0:
+        # Split every patch into stride sized blocks, the blocks at the same offset inside their patches never
+        # overlap so each offset is a single vectorised add over all patches
+        k_h, k_w = patch_h//stride_h, patch_w//stride_w
+        blocks = preds.reshape(N_imgs, N_patches_h, N_patches_w, C, k_h, stride_h, k_w, stride_w)
+        full_blocks = full_prob.reshape(N_imgs, C, N_patches_h+k_h-1, stride_h, N_patches_w+k_w-1, stride_w)
+        for a in range(k_h):
+            for b in range(k_w):
+                full_blocks[:, :, a:a+N_patches_h, :, b:b+N_patches_w, :] += \
+                    blocks[:, :, :, :, a, :, b, :].transpose(0, 3, 1, 4, 2, 5)
+    else:
+        for h in range(N_patches_h):
+            for w in range(N_patches_w):
+                full_prob[:, :, h*stride_h:(h*stride_h)+patch_h, w*stride_w:(w*stride_w)+patch_w] += preds[:, h, w]
+    return full_prob
+
+
+@lru_cache(maxsize=None)
+def blending_window(patch_h, patch_w, blending='uniform'):
+    # Per pixel weight of a patch prediction: 'uniform', 'gaussian' or 'cosine' (both taper towards the patch border)
+    y = (np.arange(patch_h) + 0.5) / patch_h
+    x = (np.arange(patch_w) + 0.5) / patch_w
+    if blending == 'uniform':
+        window = np.ones((patch_h, patch_w))
+    elif blending == 'gaussian':
+        sigma = 1. / 8
+        window = np.outer(np.exp(-(y - 0.5)**2 / (2*sigma**2)), np.exp(-(x - 0.5)**2 / (2*sigma**2)))
+        window = np.maximum(window, 1e-3)
+    elif blending == 'cosine':
+        window = np.outer(np.sin(np.pi * y), np.sin(np.pi * x))
+    else:
+        raise ValueError("blending should be one of 'uniform', 'gaussian' or 'cosine', got " + str(blending))
+    window.flags.writeable = False
+    return window
+
+
+@lru_cache(maxsize=8)
+def overlap_weight_map(img_h, img_w, patch_h, patch_w, stride_h, stride_w, blending='uniform'):
+    # Normalisation map of recompone_overlap (sum of the patch weights covering every pixel). The tiling
+    # geometry is the same for every image of a given padded size, so it is computed once and cached.
+    N_patches_h = (img_h-patch_h)//stride_h+1
+    N_patches_w = (img_w-patch_w)//stride_w+1
+    window = blending_window(patch_h, patch_w, blending)
+    windows = np.broadcast_to(window, (1, N_patches_h, N_patches_w, 1, patch_h, patch_w))
+    full_sum = accumulate_overlap(np.zeros((1, 1, img_h, img_w)), windows, stride_h, stride_w)[0, 0]
+    full_sum.flags.writeable = False
+    return full_sum
+
+
+def fov_box(image, threshold=10):
+    # (top, left, bottom, right) bounding box of the fundus field of view of a channel last image, i.e. the pixels
+    # brighter than threshold (on the 0-255 scale) in any channel. None if the whole image is dark.
+    image = np.asarray(image)
+    if len(image.shape) == 3:
+        image = np.max(image, axis=-1)
+    if np.max(image) <= 1:
+        threshold = threshold / 255.
+    rows = np.flatnonzero(np.any(image > threshold, axis=1))
+    cols = np.flatnonzero(np.any(image > threshold, axis=0))
+    if len(rows) == 0 or len(cols) == 0:
+        return None
+    return (int(rows[0]), int(cols[0]), int(rows[-1])+1, int(cols[-1])+1)
+
+
+class TilingPlan(object):
+    # Overlapping patch tiling of an img_h x img_w image shared by paint_border_overlap, extract_ordered_overlap and
+    # recompone_overlap, optionally restricted to the fov (top, left, bottom, right) box. Plans only depend on the
+    # geometry, use get_tiling_plan to reuse them for every image and TTA variant of the same size.
+    def __init__(self, img_h, img_w, patch_h, patch_w, stride_h, stride_w, fov=None):
+        self.img_h, self.img_w = img_h, img_w
+        self.patch_h, self.patch_w = patch_h, patch_w
+        self.stride_h, self.stride_w = stride_h, stride_w
+        self.fov = fov
+        top, left, bottom, right = fov if fov is not None else (0, 0, img_h, img_w)
+        self.region_h, self.region_w = bottom-top, right-left
+        self.padded_h = self.region_h + (stride_h - (self.region_h-patch_h)%stride_h)%stride_h
+        self.padded_w = self.region_w + (stride_w - (self.region_w-patch_w)%stride_w)%stride_w
+        self.N_patches_h = (self.padded_h-patch_h)//stride_h+1
+        self.N_patches_w = (self.padded_w-patch_w)//stride_w+1
+        self.N_patches_img = self.N_patches_h*self.N_patches_w
+        # (N_patches_img, 2) top left corner of every patch in the padded image, in extract_ordered_overlap order
+        rows, cols = np.meshgrid(np.arange(self.N_patches_h)*stride_h, np.arange(self.N_patches_w)*stride_w, indexing='ij')
+        self.coords = np.stack([rows.ravel(), cols.ravel()], axis=1)
+        self.coords.flags.writeable = False
+
+    @property
+    def is_padded(self):
+        # images of this size need neither padding nor fov cropping
+        return self.fov is None and (self.padded_h, self.padded_w) == (self.img_h, self.img_w)
+
+    def pad(self, full_imgs, dtype=np.float64):
+        # (N, C, img_h, img_w) -> (N, C, padded_h, padded_w), cropping to the fov and padding in a single allocation
+        assert (full_imgs.shape[2:]==(self.img_h, self.img_w))
+        if self.is_padded:
+            return full_imgs
+        top, left = self.fov[:2] if self.fov is not None else (0, 0)
+        padded = np.zeros((full_imgs.shape[0], full_imgs.shape[1], self.padded_h, self.padded_w), dtype=dtype)
+        padded[:, :, :self.region_h, :self.region_w] = full_imgs[:, :, top:top+self.region_h, left:left+self.region_w]
+        return padded
+
+    def crop(self, full_imgs):
+        # inverse of pad: (N, C, padded_h, padded_w) -> (N, C, img_h, img_w), zero outside of the fov
+        if self.fov is None:
+            return full_imgs[:, :, :self.img_h, :self.img_w]
+        top, left = self.fov[:2]
+        out = np.zeros((full_imgs.shape[0], full_imgs.shape[1], self.img_h, self.img_w), dtype=full_imgs.dtype)
+        out[:, :, top:top+self.region_h, left:left+self.region_w] = full_imgs[:, :, :self.region_h, :self.region_w]
+        return out
+
+    def view(self, padded_imgs):
+        return view_ordered_overlap(padded_imgs, self.patch_h, self.patch_w, self.stride_h, self.stride_w)
+
+    def extract(self, padded_imgs, channel_last=False, dtype=np.float64):
+        # (N*N_patches_img, C, patch_h, patch_w) patches (channel last if asked) copied out of the strided view at once
+        windows = self.view(padded_imgs)
+        if channel_last:
+            windows = windows.transpose(0, 1, 2, 4, 5, 3)
+        patches = np.empty((windows.shape[0]*self.N_patches_img, *windows.shape[3:]), dtype=dtype)
+        np.copyto(patches.reshape(windows.shape), windows, casting='unsafe')
+        return patches
+
+    def iter_batches(self, padded_imgs, batch_size=16, channel_last=False, dtype=np.float32):
+        return iter_ordered_overlap(padded_imgs, self.patch_h, self.patch_w, self.stride_h, self.stride_w,
+                                    batch_size, channel_last, dtype)
+
+    def weight_map(self, blending='uniform'):
+        return overlap_weight_map(self.padded_h, self.padded_w, self.patch_h, self.patch_w,
+                                  self.stride_h, self.stride_w, blending)
+
+    def recompone(self, preds, blending='uniform'):
+        # (N*N_patches_img, C, patch_h, patch_w) predictions -> (N, C, padded_h, padded_w) average
+        N_full_imgs = preds.shape[0]//self.N_patches_img
+        full_prob = np.zeros((N_full_imgs, preds.shape[1], self.padded_h, self.padded_w))
+        preds = preds.reshape(N_full_imgs, self.N_patches_h, self.N_patches_w, *preds.shape[1:])
+        if blending != 'uniform':
+            preds = preds * blending_window(self.patch_h, self.patch_w, blending)
+        accumulate_overlap(full_prob, preds, self.stride_h, self.stride_w)
+        full_sum = self.weight_map(blending)
+        assert(np.min(full_sum)>0)  #every pixel is covered
+        full_prob /= full_sum
+        if blending != 'uniform':
+            np.clip(full_prob, 0.0, 1.0, out=full_prob)   # weighted average can overshoot by rounding only
+        return full_prob
+
+    def predict_streaming(self, predict_fn, padded_imgs, batch_size=16, blending='uniform'):
+        # see predict_overlap, returns the (N, C', padded_h, padded_w) average
+        window = blending_window(self.patch_h, self.patch_w, blending)
+        full_prob = None
+        k = 0   #iterator over all the patches
+        for batch in self.iter_batches(padded_imgs, batch_size, channel_last=True):
+            preds = np.asarray(predict_fn(batch))
+            if full_prob is None:
+                full_prob = np.zeros((padded_imgs.shape[0], preds.shape[-1], self.padded_h, self.padded_w), dtype=np.float32)
+            for pred in preds:
+                i, k_img = divmod(k, self.N_patches_img)
+                h, w = self.coords[k_img]
+                pred = pred.transpose(2, 0, 1)
+                if blending != 'uniform':
+                    pred = pred * window
+                full_prob[i, :, h:h+self.patch_h, w:w+self.patch_w] += pred
+                k += 1
+        assert (k==padded_imgs.shape[0]*self.N_patches_img)
+        full_prob /= self.weight_map(blending)
+        np.clip(full_prob, 0.0, 1.0, out=full_prob)
+        return full_prob
+
+    def predict(self, predict_fn, full_imgs, batch_size=16, streaming=False, blending='uniform'):
+        # Pad (and fov crop) the (N, C, img_h, img_w) images, predict every patch with predict_fn (channel last
+        # patches in, channel last predictions out) and recompone the (N, C', img_h, img_w) predictions.
+        # streaming feeds predict_fn batch_size patches at a time, otherwise all the patches are passed at once.
+        padded = self.pad(full_imgs)
+        if streaming:
+            full_prob = self.predict_streaming(predict_fn, padded, batch_size, blending)
+        else:
+            preds = np.asarray(predict_fn(self.extract(padded, channel_last=True, dtype=np.float32)))
+            full_prob = self.recompone(preds.transpose(0, 3, 1, 2), blending)
+        return self.crop(full_prob)
+
+
+@lru_cache(maxsize=32)
+def get_tiling_plan(img_h, img_w, patch_h, patch_w, stride_h, stride_w, fov=None):
+    return TilingPlan(img_h, img_w, patch_h, patch_w, stride_h, stride_w, fov)
+
+
+def file_digest(file):
+    sha1 = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def load_manifest(manifest_path):
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            return json.load(f)
+    return {'params': None, 'files': {}}
+
+
+def save_manifest(manifest, manifest_path):
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def _init_worker():
+    cv2.setNumThreads(1)    # parallelism comes from the process pool
+
+
+def _pre_process_file(args):
+    file, out_file, params = args
+    image = np.asarray(Image.open(file))[:, :, :3]
+    out = pre_process_images(np.expand_dims(image, axis=0), **params)[0]
+    if out.shape[2] == 1:
+        out = out[:, :, 0]
+    Image.fromarray(out).save(out_file)
+    return file
+
+
+def pre_process_dataset(input_files, result_dir, params, workers=None, manifest_name=MANIFEST_NAME):
+    # Incremental preprocessing of input_files into result_dir. The manifest keeps the content hash of every input
+    # together with the preprocessing params, only new or modified images (or all of them when the params change)
+    # are processed again, in a process pool.
+    manifest_path = os.path.join(result_dir, manifest_name)
+    manifest = load_manifest(manifest_path)
+    if manifest['params'] != params:
+        manifest = {'params': params, 'files': {}}
+    old_entries = manifest['files']
+    entries = {}
+    tasks = []
+    for file in tqdm(input_files, desc="Checking Images"):
+        image_name = ''.join(file.replace('\\', '/').split('/')[-1].split('.')[:-1])
+        out_file = os.path.join(result_dir, image_name + '.png')
+        stat = os.stat(file)
+        entry = old_entries.get(image_name)
+        if entry is not None and (entry['size'], entry['mtime']) == (stat.st_size, stat.st_mtime):
+            digest = entry['sha1']  # unchanged file, skip hashing
+        else:
+            digest = file_digest(file)
+        entries[image_name] = {'sha1': digest, 'size': stat.st_size, 'mtime': stat.st_mtime}
+        if entry is None or entry['sha1'] != digest or not os.path.isfile(out_file):
+            tasks.append((file, out_file, params))
+    print("{} of {} images to process".format(len(tasks), len(input_files)))
+    if tasks:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+            for _ in tqdm(executor.map(_pre_process_file, tasks, chunksize=4), total=len(tasks), desc="Processing Images"):
+                pass
+    manifest['files'] = entries
+    save_manifest(manifest, manifest_path)
+    return [task[0] for task in tasks]
+
+
 def main():
-    input_files = glob('training_dataset/input/*png')
+    input_files = sorted(glob('training_dataset/input/*png'))
     result_dir = 'training_dataset/pre-processed/'
-    images = read_training_images(input_files)
-    processed = []
-    for i in tqdm(range(len(input_files)), desc="Processing Images"):
-        file, image = input_files[i], images[i]
-        image_name = ''.join(file.replace('\\', '/').split('/')[-1].split('.')[:-1])
-        out = np.array(pre_process_image(image, True, gamma=1., multi_gamma_channel=False), dtype=np.uint8)
-        if out.shape[2] == 1:
-            out = out[:, :, 0]
-        # out = np.repeat(out, repeats=[3], axis=-1)
-        # cv2.imwrite(result_dir + image_name + '.png', out)
-        Image.fromarray(out).save(result_dir + image_name + '.png')
-        processed.append(out)
+    params = {'gamma': 1., 'gamma_offset': 0.4, 'multi_gamma_channel': False, 'clip_limit': 2.0, 'tile_grid_size': [8, 8]}
+    pre_process_dataset(input_files, result_dir, params)
 
 
 if __name__ == '__main__':
@@ -3,9 +3,7 @@ from pprint import pprint as pp
 from PIL import Image
 import numpy as np
 from pre_process import pre_process_image
-from pre_process import extract_ordered_overlap
-from pre_process import paint_border_overlap
-from pre_process import recompone_overlap
+from pre_process import get_tiling_plan
 import BCDU.models as M
 from matplotlib import pyplot as plt
 import os
@@ -43,29 +41,27 @@ for k, model_path in enumerate(models_path, 1):
         image = pre_process_image(image, gamma=0.9)
 
         #extend both images and masks so they can be divided exactly by the patches dimensions
-        image = paint_border_overlap(image, *PATCH_SIZE, *STRIDE_SIZE)
-        new_size = (image.shape[2], image.shape[3])
+        plan = get_tiling_plan(*image.shape[2:], *PATCH_SIZE, *STRIDE_SIZE)
+        image = plan.pad(image)
 
         print ("\ntest images/masks shape:")
         print (image.shape)
         print ("test images range (min-max): " +str(np.min(image)) +' - '+str(np.max(image)))
         print ("test masks are within 0-1\n")
 
-        image_patches = extract_ordered_overlap(image, *PATCH_SIZE, *STRIDE_SIZE)
+        image_patches = plan.extract(image, channel_last=True, dtype=np.float32)
 
         print ("\ntest PATCHES images/masks shape:")
         print (image_patches.shape)
         print ("test PATCHES images range (min-max): " +str(np.min(image_patches)) +' - '+str(np.max(image_patches)))
         
         # Prediction
-        image_patches = np.einsum('klij->kijl', image_patches)
         predictions = model.predict(image_patches, batch_size=16, verbose=1)
         predictions = np.einsum('kijl->klij', predictions)
 
-        orinal_image = recompone_overlap(predictions, *new_size, *STRIDE_SIZE)
+        orinal_image = plan.crop(plan.recompone(predictions))
         print(orinal_image.shape)
         orinal_image = np.einsum('klij->kijl', orinal_image)
-        orinal_image = orinal_image[:, 0:IMG_SIZE[1], 0:IMG_SIZE[0], :]
         image_name = ''.join(file_name.replace('\\', '/').split('/')[-1].split('.')[:-1])
         save_image_path = RESULT_DIR + '/' + image_name + '_' + str(PATCH_SIZE) + '_' + str(STRIDE_SIZE) + \
                           '_{}bcdu.jpg'.format('_'.join(model_path.replace('\\', '/').split('/')[-1].split('-')[:2]))
@@ -0,0 +1,60 @@
+import numpy as np
+import os
+import tensorflow as tf
+from functools import lru_cache
+
+
+SIGNATURE_INPUT = 'images'
+SIGNATURE_OUTPUT = 'output'
+
+
+def export_model(model, export_dir):
+    # SavedModel of a keras inference model with a fixed 'serving_default' signature:
+    # float32 images [None, *model input shape] -> {'output': first model output}
+    input_shape = tuple(model.inputs[0].shape[1:])
+
+    @tf.function(input_signature=[tf.TensorSpec((None,) + input_shape, tf.float32, name=SIGNATURE_INPUT)])
+    def serve(images):
+        outputs = model(images, training=False)
+        if isinstance(outputs, (list, tuple)):
+            outputs = outputs[0]
+        return {SIGNATURE_OUTPUT: outputs}
+
+    if os.path.dirname(export_dir) and not os.path.isdir(os.path.dirname(export_dir)):
+        os.makedirs(os.path.dirname(export_dir))
+    tf.saved_model.save(model, export_dir, signatures={'serving_default': serve})
+
+
+def is_exported(export_dir):
+    return os.path.isfile(os.path.join(export_dir, 'saved_model.pb'))
+
+
+class ServingModel(object):
+    # Exported model behind the predict / predict_on_batch calls the inference scripts make on keras models
+    def __init__(self, export_dir):
+        self.export_dir = export_dir
+        self.loaded = tf.saved_model.load(export_dir)
+        self.signature = self.loaded.signatures['serving_default']
+        self.input_shape = tuple(self.signature.structured_input_signature[1][SIGNATURE_INPUT].shape)
+
+    def predict_on_batch(self, x):
+        return self.signature(**{SIGNATURE_INPUT: tf.constant(x, dtype=tf.float32)})[SIGNATURE_OUTPUT].numpy()
+
+    def predict(self, x, batch_size=32, verbose=0):
+        if len(x) <= batch_size:
+            return self.predict_on_batch(x)
+        return np.concatenate([self.predict_on_batch(x[i:i+batch_size]) for i in range(0, len(x), batch_size)])
+
+
+def load_serving_model(export_dir, build):
+    # The SavedModel written by export_models.py when there is one, build() (the model from its training checkpoint)
+    # otherwise
+    if is_exported(export_dir):
+        return ServingModel(export_dir)
+    return build()
+
+
+def lazy_model(export_dir, build):
+    # get_model() of an inference module: load_serving_model(export_dir, build) on the first call, the same model
+    # afterwards, so importing the module stays cheap
+    return lru_cache(maxsize=None)(lambda: load_serving_model(export_dir, build))
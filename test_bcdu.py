@@ -3,10 +3,10 @@ from pprint import pprint as pp
 from PIL import Image
 import numpy as np
 from pre_process import pre_process_image
-from pre_process import extract_ordered_overlap
-from pre_process import paint_border_overlap
-from pre_process import recompone_overlap
+from pre_process import get_tiling_plan
+from pre_process import fov_box
 import BCDU.models as M
+from serving import lazy_model
 import os
 import tensorflow as tf
 from tqdm import tqdm
@@ -18,14 +18,24 @@ IMAGE_RESIZE_PER = 1         # Resize Percentage
 PATCH_SIZE = (128, 128)           # (height, width)
 STRIDE_SIZE = (64, 64)          # (height, width)
 IMG_SIZE = None
+STREAMING = False                 # Predict patches in bounded memory batches (needed for full resolution HRF)
+STREAM_BATCH_SIZE = 16
+FOV_CROP = False                  # Only tile the bounding box of the fundus field of view
 
 DIR_NAME = '../retcam'
 RESULT_DIR = DIR_NAME + '_authors_bcdu_rotation'
 MODEL_PATH = 'models/bcdu_authors_weight.hdf5'
+SERVING_PATH = 'models/serving/bcdu'     # written by export_models.py, MODEL_PATH is used when missing
 
 
-model = M.BCDU_net_D3(input_size = (*PATCH_SIZE, 1))
-model.load_weights(MODEL_PATH)
+def build_model():
+    bcdu_model = M.BCDU_net_D3(input_size = (*PATCH_SIZE, 1))
+    bcdu_model.load_weights(MODEL_PATH)
+    return bcdu_model
+
+
+get_model = lazy_model(SERVING_PATH, build_model)
+
 
 def rotate_image(image, deg=45):
     return ndimage.rotate(np.asarray(image), deg, reshape=True)
@@ -51,7 +61,7 @@ def undo_rotate_image(image, deg=45, shape=None):
     return rotated_image[h:h+img_height, w:w+img_width]
 
 
-def segment_vessel_bcdu(image, image_scale_percentage=1, th_value=150):
+def segment_vessel_bcdu(image, image_scale_percentage=1, th_value=150, streaming=STREAMING):
     img = np.copy(image)
     if np.max(img) > 1:
         img = np.array(img/255., dtype=np.float)
@@ -61,22 +71,17 @@ def segment_vessel_bcdu(image, image_scale_percentage=1, th_value=150):
         img = np.expand_dims(img, axis=-1)
     img = tf.image.resize(img, img_size)
     img = img[:, :, 0:3]
+    fov = fov_box(img) if FOV_CROP else None
 
     img = pre_process_image(img, gamma=0.9)
 
-    #extend both images and masks so they can be divided exactly by the patches dimensions
-    img = paint_border_overlap(img, *PATCH_SIZE, *STRIDE_SIZE, verbose=False)
-    new_size = (img.shape[2], img.shape[3])
-
-    image_patches = extract_ordered_overlap(img, *PATCH_SIZE, *STRIDE_SIZE, verbose=False)
-    # Prediction
-    image_patches = np.einsum('klij->kijl', image_patches)
-    predictions = model.predict(image_patches, batch_size=16)
-    predictions = np.einsum('kijl->klij', predictions)
-
-    original_image = recompone_overlap(predictions, *new_size, *STRIDE_SIZE, verbose=False)
-    original_image = np.einsum('klij->kijl', original_image)
-    original_image = original_image[0, 0:img_size[0], 0:img_size[1], :]
+    # Padding, patch extraction and recomposition all share the cached tiling plan of this image size
+    plan = get_tiling_plan(*img_size, *PATCH_SIZE, *STRIDE_SIZE, fov)
+    if streaming:
+        original_image = plan.predict(get_model().predict_on_batch, img, batch_size=STREAM_BATCH_SIZE, streaming=True)
+    else:
+        original_image = plan.predict(lambda patches: get_model().predict(patches, batch_size=16), img)
+    original_image = np.einsum('klij->kijl', original_image)[0]
     rgb_image = np.repeat(original_image, 3, axis=-1)
     threshold = cv2.threshold(rgb_image, th_value/255, 255/255, cv2.THRESH_BINARY)[1]
     
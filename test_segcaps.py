@@ -3,44 +3,44 @@ from pprint import pprint as pp
 from PIL import Image
 import numpy as np
 from pre_process import pre_process_image
-from pre_process import extract_ordered_overlap
-from pre_process import paint_border_overlap
-from pre_process import recompone_overlap
+from pre_process import get_tiling_plan
+from pre_process import fov_box
 from matplotlib import pyplot as plt
 import os
 import cv2
-from SegCaps.capsnet import CapsNetR3
-from SegCaps.capsule_layers import ConvCapsuleLayer, Length, Mask, DeconvCapsuleLayer
+from SegCaps.capsnet import CapsNetR3, load_seg_model
+from serving import lazy_model
 import tensorflow as tf
 from tqdm import tqdm
 from scipy import ndimage
 
 
-MAX_IMG_SIZE = 640                # Rescale Image
+MAX_IMG_SIZE = 640                # Rescale Image (None to keep the full resolution)
 PATCH_SIZE = (256, 256)           # (height, width)
 STRIDE_SIZE = (128, 128)          # (height, width)
 IMG_SIZE = None
+STREAMING = False                 # Predict patches in bounded memory batches (needed for full resolution HRF)
+STREAM_BATCH_SIZE = 8
+FOV_CROP = False                  # Only tile the bounding box of the fundus field of view
+ROUTING_CHUNK = None              # Capsule output rows routed at a time, lets PREDICT_BATCH_SIZE > 1 fit in memory
+PREDICT_BATCH_SIZE = 1
+GROUPED_VOTES = False             # Grouped convolution votes, the folded ones mix the patches of batches larger than 1
 
 DIR_NAME = '../retcam'
 RESULT_DIR = DIR_NAME + '_caps_results_rop_2'
 # MODEL_PATH = 'models/segcaps-multi-channel-2-model-rop-25-0.110118-0.904971.hdf5'
 MODEL_PATH = 'models/segcaps-rop-2-model-30-0.057898-0.914384.hdf5'
+SERVING_PATH = 'models/serving/segcaps'     # written by export_models.py, MODEL_PATH is used when missing
 
 
 input_shape=(256, 256, 1)
-train_model, test_model, manip_model = CapsNetR3(input_shape)
-model = tf.keras.models.load_model(MODEL_PATH, 
-                                    custom_objects={
-                                        'ConvCapsuleLayer': ConvCapsuleLayer,
-                                        'Mask': Mask,
-                                        'Length': Length,
-                                        'DeconvCapsuleLayer': DeconvCapsuleLayer
-                                    }, compile=False)
 
-for test_layer in test_model.layers:
-    for train_layer in model.layers:
-        if train_layer.name == test_layer.name:
-            test_layer.set_weights(train_layer.get_weights())
+
+def build_model():
+    return load_seg_model(MODEL_PATH, input_shape, CapsNetR3, routing_chunk=ROUTING_CHUNK, grouped_votes=GROUPED_VOTES)
+
+
+get_model = lazy_model(SERVING_PATH, build_model)
 
 
 def rotate_image(image, deg=45):
@@ -67,7 +67,7 @@ def undo_rotate_image(image, deg=45, shape=None):
     return rotated_image[h:h+img_height, w:w+img_width]
 
 
-def get_vessel_map(image, th_value=150, max_image_size=MAX_IMG_SIZE, rescale=True, rotated_image=False):
+def get_vessel_map(image, th_value=150, max_image_size=MAX_IMG_SIZE, rescale=True, rotated_image=False, streaming=STREAMING):
     img = np.copy(image)
     if np.max(img) > 1:
         img = np.array(img/255., dtype=np.float)
@@ -75,22 +75,14 @@ def get_vessel_map(image, th_value=150, max_image_size=MAX_IMG_SIZE, rescale=Tru
     if not rotated_image and rescale:
         img = rescale_image(img, max_image_size)
     img = img[:, :, :3]
-    img_size = img.shape[:2]
+    fov = fov_box(img) if FOV_CROP else None
     img = pre_process_image(img, gamma=1.0, multi_gamma_channel=False)
 
-    #extend both images and masks so they can be divided exactly by the patches dimensions
-    img = paint_border_overlap(img, *PATCH_SIZE, *STRIDE_SIZE, verbose=False)
-    new_size = (img.shape[2], img.shape[3])
-
-    image_patches = extract_ordered_overlap(img, *PATCH_SIZE, *STRIDE_SIZE, verbose=False)
-    # Prediction
-    image_patches = np.einsum('klij->kijl', image_patches)
-    predictions = test_model.predict(image_patches, batch_size=1)[0]
-    predictions = np.einsum('kijl->klij', predictions)
-
-    original_image = recompone_overlap(predictions, *new_size, *STRIDE_SIZE, verbose=False)
-    original_image = np.einsum('klij->kijl', original_image)
-    original_image = original_image[0, 0:img_size[0], 0:img_size[1], :]
+    # Padding, patch extraction and recomposition all share the cached tiling plan of this image size
+    plan = get_tiling_plan(*img.shape[2:], *PATCH_SIZE, *STRIDE_SIZE, fov)
+    original_image = plan.predict(lambda patches: get_model().predict(patches, batch_size=PREDICT_BATCH_SIZE), img,
+                                  batch_size=STREAM_BATCH_SIZE, streaming=streaming)
+    original_image = np.einsum('klij->kijl', original_image)[0]
     rgb_image = np.repeat(original_image, 3, axis=-1)
     threshold = cv2.threshold(rgb_image, th_value/255, 255/255, cv2.THRESH_BINARY)[1][:, :, :1]
     
@@ -98,7 +90,7 @@ def get_vessel_map(image, th_value=150, max_image_size=MAX_IMG_SIZE, rescale=Tru
 
 def rescale_image(image, max_image_size=640):
     image_scale_percentage = 1
-    if np.max(image.shape[:2]) > max_image_size:
+    if max_image_size is not None and np.max(image.shape[:2]) > max_image_size:
         if image.shape[0] > image.shape[1]:
             image_scale_percentage = max_image_size/image.shape[0]
         else:
@@ -110,34 +102,34 @@ def rescale_image(image, max_image_size=640):
     return tf.image.resize(image, img_size)
 
 
-def segment_vessel_capsnet(img, th_value=150, max_image_size=MAX_IMG_SIZE, rescale=True, img_transform=False):
+def segment_vessel_capsnet(img, th_value=150, max_image_size=MAX_IMG_SIZE, rescale=True, img_transform=False, streaming=STREAMING):
     image = np.asarray(img)
     if rescale:
         image = rescale_image(image, max_image_size=max_image_size)
     (h, w) = image.shape[:2]
-    img, th = get_vessel_map(image, th_value=th_value, max_image_size=max_image_size, rescale=rescale)
+    img, th = get_vessel_map(image, th_value=th_value, max_image_size=max_image_size, rescale=rescale, streaming=streaming)
     res = np.array(img, dtype=np.float64)
     res_th = np.array(th, dtype=np.float64)
     if img_transform:
 
         # Vertical Flip
-        img, th = get_vessel_map(image[:, ::-1, ...], th_value=th_value, max_image_size=max_image_size, rescale=rescale)
+        img, th = get_vessel_map(image[:, ::-1, ...], th_value=th_value, max_image_size=max_image_size, rescale=rescale, streaming=streaming)
         res += img[:, ::-1, ...]
         res_th += th[:, ::-1, ...]
 
         # Vertical Flip
-        img, th = get_vessel_map(image[::-1, :, ...], th_value=th_value, max_image_size=max_image_size, rescale=rescale)
+        img, th = get_vessel_map(image[::-1, :, ...], th_value=th_value, max_image_size=max_image_size, rescale=rescale, streaming=streaming)
         res += img[::-1, :, ...]
         res_th += th[::-1, :, ...]
 
         # Horizontal & Vertical Flip
-        img, th = get_vessel_map(image[::-1, ::-1, ...], th_value=th_value, max_image_size=max_image_size, rescale=rescale)
+        img, th = get_vessel_map(image[::-1, ::-1, ...], th_value=th_value, max_image_size=max_image_size, rescale=rescale, streaming=streaming)
         res += img[::-1, ::-1, ...]
         res_th += th[::-1, ::-1, ...]
 
         # Rotate by 30 deg
         deg = 30
-        img, th = get_vessel_map(rotate_image(image, deg=deg), th_value=th_value, max_image_size=max_image_size, rescale=rescale, rotated_image=True)
+        img, th = get_vessel_map(rotate_image(image, deg=deg), th_value=th_value, max_image_size=max_image_size, rescale=rescale, rotated_image=True, streaming=streaming)
         r = undo_rotate_image(img, deg=deg, shape=(h, w))
         r[r > 1] = 1
         r[r < 0] = 0
@@ -149,7 +141,7 @@ def segment_vessel_capsnet(img, th_value=150, max_image_size=MAX_IMG_SIZE, resca
 
         # Rotate by 45 deg
         deg = 45
-        img, th = get_vessel_map(rotate_image(image, deg=deg), th_value=th_value, max_image_size=max_image_size, rescale=rescale, rotated_image=True)
+        img, th = get_vessel_map(rotate_image(image, deg=deg), th_value=th_value, max_image_size=max_image_size, rescale=rescale, rotated_image=True, streaming=streaming)
         r = undo_rotate_image(img, deg=deg, shape=(h, w))
         r[r > 1] = 1
         r[r < 0] = 0
@@ -161,7 +153,7 @@ def segment_vessel_capsnet(img, th_value=150, max_image_size=MAX_IMG_SIZE, resca
 
         # Rotate by 60 deg
         deg = 60
-        img, th = get_vessel_map(rotate_image(image, deg=deg), th_value=th_value, max_image_size=max_image_size, rescale=rescale, rotated_image=True)
+        img, th = get_vessel_map(rotate_image(image, deg=deg), th_value=th_value, max_image_size=max_image_size, rescale=rescale, rotated_image=True, streaming=streaming)
         r = undo_rotate_image(img, deg=deg, shape=(h, w))
         r[r > 1] = 1
         r[r < 0] = 0
@@ -3,14 +3,12 @@ from pprint import pprint as pp
 from PIL import Image
 import numpy as np
 from pre_process import pre_process_image
-from pre_process import extract_ordered_overlap
-from pre_process import paint_border_overlap
-from pre_process import recompone_overlap
+from pre_process import get_tiling_plan
 from matplotlib import pyplot as plt
 import os
 import cv2
-from SegCaps.capsnet import CapsNetR3, CapsNetR4
-from SegCaps.capsule_layers import ConvCapsuleLayer, Length, Mask, DeconvCapsuleLayer
+from SegCaps.capsnet import CapsNetR4, load_seg_model
+from serving import lazy_model
 import tensorflow as tf
 from tqdm import tqdm
 from scipy import ndimage
@@ -25,22 +23,17 @@ IMG_SIZE = None
 DIR_NAME = '../neo'
 RESULT_DIR = DIR_NAME + '_caps_results_full_150'
 MODEL_PATH = 'models/segcaps-full-model-150-0.162590-0.890193.hdf5'
+SERVING_PATH = 'models/serving/segcaps_full'     # written by export_models.py, MODEL_PATH is used when missing
 
 
 input_shape=(512, 512, 1)
-train_model, test_model, manip_model = CapsNetR4(input_shape)
-model = tf.keras.models.load_model(MODEL_PATH, 
-                                    custom_objects={
-                                        'ConvCapsuleLayer': ConvCapsuleLayer,
-                                        'Mask': Mask,
-                                        'Length': Length,
-                                        'DeconvCapsuleLayer': DeconvCapsuleLayer
-                                    }, compile=False)
 
-for test_layer in test_model.layers:
-    for train_layer in model.layers:
-        if train_layer.name == test_layer.name:
-            test_layer.set_weights(train_layer.get_weights())
+
+def build_model():
+    return load_seg_model(MODEL_PATH, input_shape, CapsNetR4)
+
+
+get_model = lazy_model(SERVING_PATH, build_model)
 
 
 def rotate_image(image, deg=45):
@@ -79,19 +72,9 @@ def segment_vessel_capsnet(image, image_scale_percentage=1, th_value=150):
 
     image = pre_process_image(image, gamma=0.9)
 
-    #extend both images and masks so they can be divided exactly by the patches dimensions
-    image = paint_border_overlap(image, *PATCH_SIZE, *STRIDE_SIZE, verbose=False)
-    new_size = (image.shape[2], image.shape[3])
-
-    image_patches = extract_ordered_overlap(image, *PATCH_SIZE, *STRIDE_SIZE, verbose=False)
-    # Prediction
-    image_patches = np.einsum('klij->kijl', image_patches)
-    predictions = test_model.predict(image_patches, batch_size=1)[0]
-    predictions = np.einsum('kijl->klij', predictions)
-
-    original_image = recompone_overlap(predictions, *new_size, *STRIDE_SIZE, verbose=False)
-    original_image = np.einsum('klij->kijl', original_image)
-    original_image = original_image[0, 0:img_size[0], 0:img_size[1], :]
+    plan = get_tiling_plan(*img_size, *PATCH_SIZE, *STRIDE_SIZE)
+    original_image = plan.predict(lambda patches: get_model().predict(patches, batch_size=1), image)
+    original_image = np.einsum('klij->kijl', original_image)[0]
     rgb_image = np.repeat(original_image, 3, axis=-1)
     threshold = cv2.threshold(rgb_image, th_value/255, 255/255, cv2.THRESH_BINARY)[1]
     
@@ -113,7 +96,7 @@ def segment_vessel_full_capsnet(image, image_scale_percentage=1, th_value=150):
     image = pre_process_image(image, gamma=0.9)
 
     image_patches = np.einsum('klij->kijl', image)
-    pred = test_model.predict(image_patches, batch_size=1)[0][0]
+    pred = get_model().predict(image_patches, batch_size=1)[0]
     if h != w:
         if h > w:
             diff = int((img_size[1] - img_size[0]*w/h)/2)
@@ -0,0 +1,22 @@
+import os
+import numpy as np
+import pytest
+from PIL import Image
+
+
+@pytest.fixture
+def write_dataset(tmp_path):
+    # write(seed, ...) writes input/{i}.png images (image_channels of them, 1 gives a grayscale png as
+    # pre_process.main writes) and label/{i}.png masks under tmp_path/name, returns that dataset root
+    def write(seed=0, count=3, size=(80, 96), image_channels=3, name='dataset'):
+        rng = np.random.RandomState(seed)
+        root = str(tmp_path / name)
+        for directory in ('input', 'label'):
+            os.makedirs(os.path.join(root, directory))
+        image_size = size + (image_channels,) if image_channels > 1 else size
+        for i in range(count):
+            Image.fromarray(rng.randint(0, 256, image_size).astype(np.uint8)).save(os.path.join(root, 'input', '{}.png'.format(i)))
+            Image.fromarray((rng.rand(*size) > 0.8).astype(np.uint8) * 255).save(os.path.join(root, 'label', '{}.png'.format(i)))
+        return root
+
+    return write
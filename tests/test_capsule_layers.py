@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from SegCaps.capsule_layers import _squash, update_routing
+
+
+def while_loop_routing(votes, biases, logit_shape, num_dims, input_dim, output_dim, num_routing):
+    # update_routing as it was before the unrolling, the reference for identical outputs
+    if num_dims == 6:
+        votes_t_shape = [5, 0, 1, 2, 3, 4]
+        r_t_shape = [1, 2, 3, 4, 5, 0]
+    else:
+        votes_t_shape = [3, 0, 1, 2]
+        r_t_shape = [1, 2, 3, 0]
+    votes_trans = tf.transpose(votes, votes_t_shape)
+
+    def _body(i, logits, activations):
+        route = tf.nn.softmax(logits, axis=-1)
+        preactivate_unrolled = route * votes_trans
+        preact_trans = tf.transpose(preactivate_unrolled, r_t_shape)
+        preactivate = tf.reduce_sum(preact_trans, axis=1) + biases
+        activation = _squash(preactivate)
+        activations = activations.write(i, activation)
+        act_3d = tf.keras.backend.expand_dims(activation, 1)
+        tile_shape = np.ones(num_dims, dtype=np.int32).tolist()
+        tile_shape[1] = input_dim
+        act_replicated = tf.tile(act_3d, tile_shape)
+        distances = tf.reduce_sum(votes * act_replicated, axis=-1)
+        logits += distances
+        return (i + 1, logits, activations)
+
+    activations = tf.TensorArray(dtype=tf.float32, size=num_routing, clear_after_read=False)
+    logits = tf.fill(logit_shape, 0.0)
+    i = tf.constant(0, dtype=tf.int32)
+    _, logits, activations = tf.while_loop(lambda i, logits, activations: i < num_routing, _body,
+                                           loop_vars=[i, logits, activations], swap_memory=True)
+    return tf.keras.backend.cast(activations.read(num_routing - 1), dtype='float32')
+
+
+@pytest.mark.parametrize('num_dims', [4, 6])
+@pytest.mark.parametrize('num_routing', [1, 3])
+def test_unrolled_routing_matches_while_loop(num_dims, num_routing):
+    rng = np.random.RandomState(0)
+    batch, input_dim, output_dim, num_atoms = 2, 4, 3, 8
+    spatial = (5, 6) if num_dims == 6 else ()
+    votes = tf.constant(rng.randn(batch, input_dim, *spatial, output_dim, num_atoms).astype(np.float32))
+    biases = tf.constant(rng.randn(output_dim, num_atoms).astype(np.float32) * 0.1)
+    logit_shape = (batch, input_dim, *spatial, output_dim)
+    expected = while_loop_routing(votes, biases, logit_shape, num_dims, input_dim, output_dim, num_routing)
+    actual = update_routing(votes, biases, logit_shape, num_dims, input_dim, output_dim, num_routing)
+    np.testing.assert_array_equal(actual.numpy(), expected.numpy())
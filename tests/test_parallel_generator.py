@@ -0,0 +1,39 @@
+import pytest
+
+from augmentation import BatchAugmenter
+from dataset_store import open_store
+from parallel_generator import parallel_batches
+from patch_sampler import PatchSampler
+
+
+PATCH_SIZE = (16, 16)
+
+
+class FailingAugmenter(BatchAugmenter):
+    def augment(self, images, labels, rng, stats=None):
+        raise ValueError('augmentation failed')
+
+
+def test_batches(write_dataset):
+    store = open_store(write_dataset(seed=0, count=2, size=(40, 48)), 'input', 'label', 'png')
+    batches = parallel_batches(store, PatchSampler(store, PATCH_SIZE), 4, 1, True, BatchAugmenter(), workers=2, seed=0)
+    for _ in range(3):
+        X, Y = next(batches)
+        assert X.shape == (4,) + PATCH_SIZE + (1,)
+        assert Y.shape == (4,) + PATCH_SIZE + (1,)
+    batches.close()
+
+
+def test_channels_of_grayscale_store(write_dataset):
+    store = open_store(write_dataset(seed=2, count=2, size=(40, 48), image_channels=1), 'input', 'label', 'png')
+    batches = parallel_batches(store, PatchSampler(store, PATCH_SIZE), 4, 3, True, BatchAugmenter(), workers=2, seed=0)
+    X, Y = next(batches)
+    assert X.shape == (4,) + PATCH_SIZE + (1,)
+    batches.close()
+
+
+def test_worker_error_is_raised(write_dataset):
+    store = open_store(write_dataset(seed=1, count=2, size=(40, 48)), 'input', 'label', 'png')
+    batches = parallel_batches(store, PatchSampler(store, PATCH_SIZE), 4, 1, True, FailingAugmenter(), workers=2, seed=0)
+    with pytest.raises(RuntimeError, match='augmentation failed'):
+        next(batches)
@@ -0,0 +1,20 @@
+from patch_generator import data_dataset, data_generator
+
+
+PATCH_SIZE = (32, 32)
+
+
+def test_dataset_channels_of_grayscale_store(write_dataset):
+    # single channel images, as pre_process.main writes them
+    root = write_dataset(seed=0, image_channels=1)
+    dataset = data_dataset(root, 'input', 'label', 'png', 2, PATCH_SIZE, input_channel=3, caps=True, seed=0)
+    (x, y), (_, mask) = next(iter(dataset))
+    assert x.shape == (2, *PATCH_SIZE, 1)
+    assert mask.shape == (2, *PATCH_SIZE, 1)
+
+
+def test_generator_channels_of_grayscale_store(write_dataset):
+    root = write_dataset(seed=1, image_channels=1)
+    (x, y), (_, mask) = next(data_generator(root, 'input', 'label', 'png', 2, PATCH_SIZE, input_channel=3, caps=True, seed=0))
+    assert x.shape == (2, *PATCH_SIZE, 1)
+    assert mask.shape == (2, *PATCH_SIZE, 1)
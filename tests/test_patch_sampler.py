@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from patch_sampler import HardExampleSampler, NEGATIVE_KEEP, PatchSampler
+
+
+PATCH_SIZE = (32, 32)
+
+
+class LabelStore(object):
+    # the part of DatasetStore the samplers read
+    def __init__(self, labels):
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.labels)
+
+    def label(self, i):
+        return self.labels[i]
+
+
+def make_store():
+    # images of very different areas and vessel densities, one smaller than the patch
+    rng = np.random.RandomState(0)
+    labels = [((rng.rand(h, w) < p) * 255).astype(np.uint8)[..., None]
+              for h, w, p in ((300, 400, 0.0005), (60, 70, 0.002), (400, 500, 0.0002), (20, 20, 0.1), (150, 150, 0.))]
+    return LabelStore(labels)
+
+
+def is_negative(store, position):
+    index, top, left = position
+    return store.label(index)[top:top+PATCH_SIZE[0], left:left+PATCH_SIZE[1]].max() == 0
+
+
+@pytest.mark.parametrize('sampler_class', [PatchSampler, HardExampleSampler])
+def test_images_picked_uniformly_with_their_own_mix(sampler_class):
+    store = make_store()
+    sampler = sampler_class(store, PATCH_SIZE)
+    assert sampler.excluded == [3]
+    positions = sampler.sample(40000, np.random.RandomState(1))
+    indices = np.array([position[0] for position in positions])
+    negatives = np.array([is_negative(store, position) for position in positions])
+    for i, index in enumerate(sampler.indices):
+        picked = indices == index
+        assert abs(picked.mean() - 1. / len(sampler.indices)) < 0.015
+        # data_generator's mix inside the image: negatives kept with NEGATIVE_KEEP chance
+        n_negative, n_positive = sampler.class_counts[True][i], sampler.class_counts[False][i]
+        expected = NEGATIVE_KEEP * n_negative / (n_positive + NEGATIVE_KEEP * n_negative)
+        assert abs(negatives[picked].mean() - expected) < 0.03
+    assert abs(negatives.mean() - sampler.negative_fraction) < 0.015
@@ -0,0 +1,25 @@
+import threading
+
+from pipeline_stats import PipelineStats
+
+
+def test_updates_from_threads():
+    stats = PipelineStats()
+
+    def update():
+        for _ in range(2000):
+            stats.count('samples')
+            stats.add_time('crop', 0.5)
+            stats.merge_times({'sample': 0.25})
+            stats.gauge('queue_depth', 1)
+
+    threads = [threading.Thread(target=update) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    summary = stats.summary()
+    assert summary['samples'] == 16000
+    assert summary['time_s'] == {'crop': 8000., 'sample': 4000.}
+    assert len(stats.gauges['queue_depth']) == 16000
+
@@ -0,0 +1,60 @@
+import os
+import numpy as np
+import pytest
+from PIL import Image
+
+from patch_bank import build_patch_bank
+from validation_cache import caps_validation_data, load_validation_set
+
+
+PATCH_SIZE = (32, 32)
+
+
+def write_png_patches(directory, rng, count=4):
+    # {:08d}_1.png grayscale image / {:08d}_2.png label pairs, as patch_generator writes them
+    os.makedirs(directory)
+    files = []
+    for i in range(count):
+        for k, patch in ((1, rng.randint(0, 256, PATCH_SIZE)), (2, (rng.rand(*PATCH_SIZE) > 0.8) * 255)):
+            files.append(os.path.join(directory, '{:08d}_{}.png'.format(i, k)))
+            Image.fromarray(patch.astype(np.uint8)).save(files[-1])
+    return files
+
+
+def check_caps_data(inputs, targets, n):
+    x, y = inputs
+    assert x.shape == (n, *PATCH_SIZE, 1)
+    assert y.shape == (n, *PATCH_SIZE, 1)
+    assert targets[0] is y
+    assert targets[1].shape == (n, *PATCH_SIZE, 1)
+    np.testing.assert_array_equal(targets[1], y * x)
+
+
+@pytest.mark.parametrize('preprocess', [False, True])
+def test_bank_validation_data(tmp_path, write_dataset, preprocess):
+    root = write_dataset(seed=0)
+    bank = build_patch_bank(root, 'input', 'label', 'png', str(tmp_path / 'bank'), 12, PATCH_SIZE, shard_size=5,
+                            input_channel=1, preprocess=preprocess, data_aug=False, workers=1)
+    X, Y = bank.load()
+    assert X.shape[-1] == 1
+    inputs, targets = caps_validation_data(X, Y, 1)
+    check_caps_data(inputs, targets, 12)
+
+
+def test_bank_of_grayscale_store(tmp_path, write_dataset):
+    root = write_dataset(seed=2, image_channels=1)
+    bank = build_patch_bank(root, 'input', 'label', 'png', str(tmp_path / 'bank'), 6, PATCH_SIZE, shard_size=5,
+                            input_channel=3, data_aug=False, workers=1)
+    X, Y = bank.load()
+    assert X.shape == (6, *PATCH_SIZE, 1)
+
+
+def test_png_and_bank_layouts_match(tmp_path):
+    rng = np.random.RandomState(1)
+    files = write_png_patches(str(tmp_path / 'patches'), rng)
+    X, Y = load_validation_set(files, PATCH_SIZE, str(tmp_path / 'cache.npz'))
+    assert X.shape[-1] == 3
+    inputs, targets = caps_validation_data(X, Y, 1)
+    check_caps_data(inputs, targets, 4)
+    # grayscale patches: the png path feeds the model the same values a 1 channel bank holds
+    np.testing.assert_array_equal(inputs[0], X[..., :1])
@@ -20,6 +20,7 @@ TOTAL_BATCHES = 10000
 TOTAL_VAL_DATA_BATCHES = 1000
 WEIGHT_FILE_NAME = 'models/bcdu_weight_dice-40-0.920886.hdf5'
 EPOCHS = 45
+WORKERS = 0                     # augmentation processes for the training generator, 0 keeps it in this process
 
 #model = M.unet2_segment(input_size = (64,64,1))
 print("Initializing Network")
@@ -38,7 +39,8 @@ history = model.fit_generator(data_generator('training_dataset',
                                              'pre-processed', 
                                              'label-1', 'png', 
                                              batch_size=BATCH_SIZE, 
-                                             patch_size=PATCH_SIZE),
+                                             patch_size=PATCH_SIZE,
+                                             workers=WORKERS),
                               steps_per_epoch=TOTAL_BATCHES,
                               epochs=EPOCHS,
                               validation_data=data_generator('testing_dataset', 
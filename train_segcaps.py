@@ -1,8 +1,12 @@
 from SegCaps.capsnet import CapsNetR3, CapsNetR4
 from glob import glob
 import tensorflow as tf
-import numpy as np
-from patch_generator import data_generator, full_image_generator
+from patch_generator import data_generator, data_dataset, full_image_generator
+from patch_bank import PatchBank
+from pipeline_stats import PipelineStats, stats_callback
+from dataset_store import open_store
+from patch_sampler import HardExampleSampler, hard_example_callback
+from validation_cache import load_validation_set, caps_validation_data, stratified_subset, validation_callback
 import os
 from SegCaps.custom_losses import weighted_binary_crossentropy_loss
 
@@ -13,30 +17,40 @@ INPUT_SHAPE = (*PATCH_SIZE, 1)
 SAVED_MODEL_PATH = 'models/segcaps-rop-2-model-30-0.057898-0.914384.hdf5'
 INITIAL_EPOCH = 0
 EPOCHS = 30
+VALIDATION_BANK = '../Corrected/val/patch_bank'     # built by patch_generator.py, the png patches are used when missing
+VALIDATION_CACHE = '../Corrected/val/validation_cache.npz'     # decoded png patches, keyed by their hashes
+VALIDATION_FRACTION = 0.25     # stratified share of the validation set scored after each epoch
+FULL_VALIDATION_EVERY = 5      # epochs between two scorings of the full validation set
+USE_TF_DATA = True             # parallel, prefetched tf.data input pipeline instead of the python generator
+SEED = None                    # fixed seed for reproducible training patches
+WORKERS = 0                    # augmentation processes when USE_TF_DATA is off, 0 keeps it in this process
+INPUT_STATS = False            # input pipeline instrumentation, written to TensorBoard and <log_dir>/input_stats.json
+HARD_EXAMPLES = False          # oversample high loss regions, the batch losses are fed back to the sampler (python generator only)
+ROUTING_CHUNK = None           # capsule output rows routed at a time, bounds the routing memory for larger batches / patches
+GROUPED_VOTES = False          # grouped convolution votes, the folded ones mix the samples of batches larger than 1
 
 
 def main():
-    model_list = CapsNetR3(INPUT_SHAPE)
+    model_list = CapsNetR3(INPUT_SHAPE, routing_chunk=ROUTING_CHUNK, grouped_votes=GROUPED_VOTES)
     train_model = model_list[0]
     train_model.summary()
 
-    validation_X = []
-    validation_Y = []
-    files = glob('../Corrected/val/patches/*.png')
-    for i, file in enumerate(files):
-        image = np.asarray(tf.keras.preprocessing.image.load_img(file, target_size=PATCH_SIZE))
-        if np.max(image) > 1:
-            image = image / 255.
-        if i % 2 == 0:
-            validation_X.append(image)
-        else:
-            validation_Y.append(image[:, :, :1])
-    validation_X = np.array(validation_X)
-    validation_Y = np.array(validation_Y)
-    mask = validation_X[:, :, :, 1:2] * validation_Y
+    if os.path.isdir(VALIDATION_BANK):
+        validation_X, validation_Y = PatchBank(VALIDATION_BANK).load()
+    else:
+        validation_X, validation_Y = load_validation_set(glob('../Corrected/val/patches/*.png'), PATCH_SIZE, VALIDATION_CACHE)
+    validation_inputs, validation_targets = caps_validation_data(validation_X, validation_Y, INPUT_SHAPE[-1])
 
     log_dir = 'segcaps-rop-2-model'
     tensorboard_callback = tf.keras.callbacks.TensorBoard(log_dir=log_dir, histogram_freq=1)
+    stats = PipelineStats() if INPUT_STATS else None
+    subset = stratified_subset(validation_Y, VALIDATION_FRACTION)
+    # first, so that the checkpoint and tensorboard callbacks see the val_ metrics
+    callbacks = [validation_callback(train_model, validation_inputs, validation_targets, subset,
+                                     FULL_VALIDATION_EVERY, batch_size=BATCH_SIZE),
+                 tensorboard_callback]
+    if stats is not None:
+        callbacks.append(stats_callback(stats, log_dir, os.path.join(log_dir, 'input_stats.json')))
     mcp_save = tf.keras.callbacks.ModelCheckpoint('models/segcaps-rop-2-model-{epoch:02d}-{loss:.6f}-{out_seg_accuracy:0.6f}.hdf5', monitor='loss', mode='min')
 
     train_model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=1e-5), loss={'out_seg': weighted_binary_crossentropy_loss(1.5), 'out_recon': 'mean_squared_error'}, metrics=['accuracy'])
@@ -47,16 +61,26 @@ def main():
         except:
             print("Failed to load Weights")
 
-    history = train_model.fit(data_generator('../Corrected', 
-                              'pre-processed', 
-                              'label', 'png', 
-                              batch_size=BATCH_SIZE, 
-                              patch_size=PATCH_SIZE,
-                              input_channel=3, caps=True),
+    sampler = None
+    if HARD_EXAMPLES:
+        sampler = HardExampleSampler(open_store('../Corrected', 'pre-processed', 'label', 'png'), PATCH_SIZE)
+        callbacks.append(hard_example_callback(sampler))
+    if USE_TF_DATA and sampler is None:
+        train_data = data_dataset('../Corrected', 'pre-processed', 'label', 'png',
+                                  batch_size=BATCH_SIZE, patch_size=PATCH_SIZE,
+                                  input_channel=3, caps=True, seed=SEED, stats=stats)
+    else:
+        train_data = data_generator('../Corrected', 
+                                    'pre-processed', 
+                                    'label', 'png', 
+                                    batch_size=BATCH_SIZE, 
+                                    patch_size=PATCH_SIZE,
+                                    input_channel=3, caps=True,
+                                    workers=WORKERS, seed=SEED, stats=stats, sampler=sampler)
+    history = train_model.fit(train_data,
                         steps_per_epoch=5000,
                         epochs=EPOCHS,
-                        validation_data=[[validation_X, validation_Y], [validation_Y, mask]],
-                        callbacks=[tensorboard_callback, mcp_save],
+                        callbacks=callbacks + [mcp_save],
                         initial_epoch=INITIAL_EPOCH)
 
 
@@ -0,0 +1,91 @@
+import numpy as np
+import os
+import hashlib
+from PIL import Image
+from pre_process import file_digest
+
+
+STRATA_BINS = (0., 0.02, 0.05, 0.1)     # vessel fraction bin edges, all-negative patches fall in the first bin
+
+
+def validation_key(files):
+    # sha1 over the names and contents of the source files
+    sha1 = hashlib.sha1()
+    for file in files:
+        sha1.update(os.path.basename(file).encode())
+        sha1.update(file_digest(file).encode())
+    return sha1.hexdigest()
+
+
+def read_patch_pairs(files, patch_size):
+    # (X, Y) from {:08d}_1.png image / {:08d}_2.png label pairs, as train_segcaps used to read them
+    validation_X = []
+    validation_Y = []
+    for i, file in enumerate(files):
+        image = np.asarray(Image.open(file).convert('RGB').resize((patch_size[1], patch_size[0]), Image.NEAREST))
+        if np.max(image) > 1:
+            image = image / 255.
+        if i % 2 == 0:
+            validation_X.append(image)
+        else:
+            validation_Y.append(image[:, :, :1])
+    return np.array(validation_X, dtype=np.float32), np.array(validation_Y, dtype=np.float32)
+
+
+def load_validation_set(files, patch_size, cache_path):
+    # Decodes the png pairs once into a compressed npz, reused as long as the source files hash the same
+    files = sorted(files)
+    key = validation_key(files)
+    if os.path.isfile(cache_path):
+        with np.load(cache_path) as cache:
+            if str(cache['key']) == key and tuple(cache['X'].shape[1:3]) == tuple(patch_size):
+                return cache['X'], cache['Y']
+    validation_X, validation_Y = read_patch_pairs(files, patch_size)
+    np.savez_compressed(cache_path + '.tmp.npz', X=validation_X, Y=validation_Y, key=key)
+    os.replace(cache_path + '.tmp.npz', cache_path)
+    return validation_X, validation_Y
+
+
+def caps_validation_data(X, Y, channels):
+    # ([x, y], [y, mask]) for the capsule train model whatever the source of the patches: the png patches are RGB,
+    # patch bank patches have the channels of their store. A 1 channel model gets the green channel, and the
+    # reconstruction target is y times that channel, as data_generator builds it.
+    if X.shape[-1] != channels:
+        X = X[..., 1:2] if channels == 1 and X.shape[-1] == 3 else X[..., :channels]
+    mask = Y * (X[..., 1:2] if X.shape[-1] == 3 else X[..., :1])
+    return [X, Y], [Y, mask]
+
+
+def stratified_subset(Y, fraction, bins=STRATA_BINS, seed=0):
+    # Sorted indices of a fixed fraction of the patches, drawn from each vessel fraction stratum in proportion
+    if fraction >= 1:
+        return np.arange(len(Y))
+    rng = np.random.RandomState(seed)
+    vessel_fraction = Y.reshape(len(Y), -1).mean(axis=1)
+    strata = np.digitize(vessel_fraction, bins[1:], right=True)
+    subset = []
+    for stratum in np.unique(strata):
+        members = np.flatnonzero(strata == stratum)
+        subset.append(rng.choice(members, max(1, int(round(fraction * len(members)))), replace=False))
+    return np.sort(np.concatenate(subset))
+
+
+def validation_callback(model, x, y, subset, full_every=5, batch_size=1):
+    # Keras callback scoring the subset after each epoch and the full validation set every full_every epochs,
+    # the results go to the epoch logs as val_<metric> (put it before the callbacks that read them).
+    # x and y are lists of arrays, like the validation_data of fit.
+    import tensorflow as tf
+    x_subset = [a[subset] for a in x]
+    y_subset = [a[subset] for a in y]
+
+    def on_epoch_end(epoch, logs=None):
+        full = full_every and (epoch + 1) % full_every == 0
+        results = model.evaluate(x if full else x_subset, y if full else y_subset, batch_size=batch_size, verbose=0, return_dict=True)
+        print("Validation on {} patches: {}".format(len(x[0]) if full else len(subset),
+                                                 ', '.join('{}={:.6f}'.format(k, v) for k, v in results.items())))
+        if logs is not None:
+            for name, value in results.items():
+                logs['val_' + name] = value
+            logs['val_full'] = float(bool(full))
+
+    return tf.keras.callbacks.LambdaCallback(on_epoch_end=on_epoch_end)